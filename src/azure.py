@@ -1,11 +1,11 @@
 import sys
 import os
-import json
 from PIL import Image
 
 from imageprocessing import make_image
 from segments import Segment
 from ocrresults import OcrPage, OcrPara, OcrLine, OcrWord
+import pageio
 
 def polygon_to_rect(poly):
 	xmin = poly[0]
@@ -26,8 +26,7 @@ class AzurePage(OcrPage):
 		if not os.path.exists(json_name):
 			print('Need JSON in', json_name)
 			exit(0)
-		with open(json_name, 'r') as f:
-			self.results = json.load(f)
+		self.results = pageio.read_json(json_name)
 		self.paras = [self.make_para(para) for para in self.results['analyzeResult']['paragraphs']]
 		self.lines = [self.make_line(line) for line in self.results['analyzeResult']['pages'][0]['lines']]
 		for line in self.lines:
@@ -0,0 +1,100 @@
+import os
+import time
+from contextlib import contextmanager
+
+# Time budgets in seconds per page and per stage, off unless set by enable or by environment
+# variables OCR_PAGE_BUDGET and OCR_STAGE_BUDGETS (as in 'ocr=60,parts=30'), which is also how
+# worker processes inherit them. The budget of a stage holds for each call of the stage.
+# Once the budget of the stage or of the page has run out, the stage takes a cheaper path
+# for the remainder of its work, and the page is recorded as degraded by that stage:
+#	ocr: words not yet recognized keep the text from Azure
+#	parts: signs not yet classified keep the closest core, without merging parts
+
+page_budget_env = 'OCR_PAGE_BUDGET'
+stage_budgets_env = 'OCR_STAGE_BUDGETS'
+
+def parse_stage_budgets(spec):
+	budgets = {}
+	for item in spec.split(','):
+		if item.strip() != '':
+			name, seconds = item.split('=')
+			budgets[name.strip()] = float(seconds)
+	return budgets
+
+def format_stage_budgets(budgets):
+	return ','.join('{}={}'.format(name, seconds) for name, seconds in budgets.items())
+
+page_budget = float(os.environ[page_budget_env]) if page_budget_env in os.environ else None
+stage_budgets = parse_stage_budgets(os.environ.get(stage_budgets_env, ''))
+page_deadline = None
+stage_deadlines = {}
+degraded = []
+
+def enable(page_seconds=None, stage_seconds=None):
+	global page_budget
+	if page_seconds is not None:
+		page_budget = page_seconds
+		os.environ[page_budget_env] = str(page_seconds)
+	if stage_seconds is not None:
+		stage_budgets.update(stage_seconds)
+		os.environ[stage_budgets_env] = format_stage_budgets(stage_budgets)
+
+# Gives list of stages by which page was degraded, filled while in context.
+@contextmanager
+def page():
+	global page_deadline, stage_deadlines, degraded
+	page_deadline = time.perf_counter() + page_budget if page_budget is not None else None
+	stage_deadlines = {}
+	degraded = []
+	try:
+		yield degraded
+	finally:
+		page_deadline = None
+
+# Part of the work for page, under the deadline of the page, possibly in another process such
+# as a pool worker; the clock of perf_counter is shared between processes. Gives list of stages
+# degraded by this part, to be passed to add_degraded for the page. The state of the budgets
+# is restored afterwards.
+@contextmanager
+def page_part(deadline):
+	global page_deadline, stage_deadlines, degraded
+	saved = page_deadline, stage_deadlines, degraded
+	page_deadline = deadline
+	stage_deadlines = {}
+	degraded = []
+	try:
+		yield degraded
+	finally:
+		page_deadline, stage_deadlines, degraded = saved
+
+def add_degraded(names):
+	for name in names:
+		if name not in degraded:
+			degraded.append(name)
+
+@contextmanager
+def stage(name):
+	if name not in stage_budgets:
+		yield
+		return
+	stage_deadlines[name] = time.perf_counter() + stage_budgets[name]
+	try:
+		yield
+	finally:
+		stage_deadlines.pop(name, None)
+
+# Whether stage is to take cheaper path from now on.
+def exceeded(name):
+	if page_deadline is None and name not in stage_deadlines:
+		return False
+	now = time.perf_counter()
+	deadlines = [deadline for deadline in [page_deadline, stage_deadlines.get(name)] if deadline is not None]
+	if all(now <= deadline for deadline in deadlines):
+		return False
+	if name not in degraded:
+		degraded.append(name)
+		print('Out of time for', name)
+	return True
+
+def is_degraded(name=None):
+	return name in degraded if name is not None else len(degraded) > 0
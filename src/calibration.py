@@ -0,0 +1,129 @@
+import os
+import json
+import fcntl
+from statistics import median
+
+from simpleocr import estimate_median_height
+
+# Calibration profile shared by all pages of a volume, stored in the directory of the pages.
+# The first few pages are calibrated in full; later pages only check that they do not
+# drift too far from the profile.
+
+profile_name = 'calibration.json'
+
+CALIBRATION_PAGES = 3
+SIZE_TOLERANCE = 0.05
+THRESHOLD_TOLERANCE = 25
+CORNER_TOLERANCE = 0.05
+
+# Threshold between black and white maximizing between-class variance of histogram.
+def otsu_threshold(im):
+	hist = im.convert('L').histogram()
+	total = sum(hist)
+	sum_all = sum(i * n for i, n in enumerate(hist))
+	sum_black = 0
+	n_black = 0
+	best_threshold = 0
+	best_var = -1
+	for i in range(256):
+		n_black += hist[i]
+		if n_black == 0:
+			continue
+		n_white = total - n_black
+		if n_white == 0:
+			break
+		sum_black += i * hist[i]
+		mean_black = sum_black / n_black
+		mean_white = (sum_all - sum_black) / n_white
+		var = n_black * n_white * (mean_black - mean_white) ** 2
+		if var > best_var:
+			best_var = var
+			best_threshold = i
+	return best_threshold
+
+def relative_corners(corners, w, h):
+	x, y, c_w, c_h = corners
+	return [x / w, y / h, (x + c_w) / w, (y + c_h) / h]
+
+class Calibration:
+	def __init__(self, directory):
+		self.filename = os.path.join(directory, profile_name)
+		self.pages = self.read_pages()
+
+	def read_pages(self):
+		if os.path.exists(self.filename):
+			with open(self.filename, 'r') as f:
+				return json.load(f)['pages']
+		return {}
+
+	def is_complete(self):
+		return len(self.pages) >= CALIBRATION_PAGES
+
+	def profile(self):
+		entries = list(self.pages.values())
+		corners = [entry['corners'] for entry in entries if entry['corners'] is not None]
+		return {'unit_height': median([entry['unit_height'] for entry in entries]),
+			'threshold': median([entry['threshold'] for entry in entries]),
+			'size': [median([entry['size'][i] for entry in entries]) for i in range(2)],
+			'corners': [median([c[i] for c in corners]) for i in range(4)] if len(corners) > 0 else None}
+
+	# Concurrent workers take turns by a lock file, and entries they added since the profile
+	# was read are kept.
+	def add_page(self, name, entry):
+		with open(self.filename + '.lock', 'w') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			self.pages = self.read_pages()
+			self.pages[name] = entry
+			tmp_name = '{}.{}.tmp'.format(self.filename, os.getpid())
+			with open(tmp_name, 'w') as f:
+				json.dump({'pages': self.pages}, f, indent=1)
+			os.replace(tmp_name, self.filename)
+
+	def drifts(self, entry):
+		profile = self.profile()
+		for val, val_profile in zip(entry['size'], profile['size']):
+			if abs(val - val_profile) > SIZE_TOLERANCE * val_profile:
+				return True
+		if abs(entry['threshold'] - profile['threshold']) > THRESHOLD_TOLERANCE:
+			return True
+		if entry['corners'] is not None and profile['corners'] is not None:
+			for val, val_profile in zip(entry['corners'], profile['corners']):
+				if abs(val - val_profile) > CORNER_TOLERANCE:
+					return True
+		return False
+
+def cheap_entry(im, corners):
+	w, h = im.size
+	return {'size': [w, h], 'threshold': otsu_threshold(im),
+		'corners': relative_corners(corners, w, h) if corners is not None else None}
+
+# Unit height of page from profile of volume. Pages before the profile is complete are
+# calibrated and added to the profile. Pages drifting too far from profile are calibrated
+# on their own.
+def calibrated_unit_height(imagefile, im, words=None, corners=None):
+	calibration = Calibration(os.path.dirname(os.path.abspath(imagefile)))
+	name = os.path.basename(imagefile)
+	if name in calibration.pages:
+		return calibration.pages[name]['unit_height']
+	entry = cheap_entry(im, corners)
+	if calibration.is_complete():
+		if not calibration.drifts(entry):
+			return calibration.profile()['unit_height']
+		print('Page drifts from calibration profile', imagefile)
+		unit_height, _, _ = estimate_median_height(im, words=words)
+		return unit_height
+	unit_height, _, _ = estimate_median_height(im, words=words)
+	entry['unit_height'] = unit_height
+	calibration.add_page(name, entry)
+	return unit_height
+
+# Unit height from profile if complete and page does not drift, otherwise None.
+def profile_unit_height(imagefile, im, corners=None):
+	calibration = Calibration(os.path.dirname(os.path.abspath(imagefile)))
+	name = os.path.basename(imagefile)
+	if name in calibration.pages:
+		return calibration.pages[name]['unit_height']
+	elif calibration.is_complete() and not calibration.drifts(cheap_entry(im, corners)):
+		return calibration.profile()['unit_height']
+	else:
+		return None
@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+from PIL import Image
+
+from train import default_sign_letter_model_dir
+from findhiero import find_signs, find_signs_reduced, count_sign_candidates, image_files
+import profiling
+
+target_dir = 'transcriptions'
+eval_name = 'evaldetection.html'
+model_dir = default_sign_letter_model_dir
+scales = [2, 4]
+
+MIN_IOU = 0.5
+
+preamble = """<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+<title>Detection at reduced scale</title>
+<style>
+table, th, td { border: 1px solid; }
+</style>
+</head>
+<body>
+"""
+postamble = """</body>
+</html>
+"""
+
+def iou(rect1, rect2):
+	x1, y1, w1, h1 = rect1
+	x2, y2, w2, h2 = rect2
+	w = min(x1 + w1, x2 + w2) - max(x1, x2)
+	h = min(y1 + h1, y2 + h2) - max(y1, y2)
+	if w <= 0 or h <= 0:
+		return 0
+	intersection = w * h
+	return intersection / (w1 * h1 + w2 * h2 - intersection)
+
+# Number of rectangles found at full resolution that are also found at reduced scale.
+def n_recalled(rects_full, rects_reduced):
+	return len([r for r in rects_full if any(iou(r, other) >= MIN_IOU for other in rects_reduced)])
+
+# Number of pairs of rectangles that overlap, which find_signs should not give.
+def n_overlapping(rects):
+	return len([(r1, r2) for i, r1 in enumerate(rects) for r2 in rects[i+1:] if iou(r1, r2) > 0])
+
+def timed(f):
+	start = time.time()
+	result = f()
+	return result, time.time() - start
+
+def eval_page(imagefile):
+	im = Image.open(imagefile)
+	rects_full, seconds_full = timed(lambda: find_signs(im, model_dir))
+	results = []
+	for scale in scales:
+		rects, seconds = timed(lambda: find_signs_reduced(im, model_dir, scale))
+		results.append((n_recalled(rects_full, rects), len(rects), seconds))
+	n_candidates, seconds_triage = timed(lambda: count_sign_candidates(im, model_dir, limit=1))
+	return len(rects_full), n_overlapping(rects_full), seconds_full, results, (n_candidates > 0, seconds_triage)
+
+def eval_row(imagefile, n_full, n_overlap, seconds_full, results, triage):
+	row = '<tr><th>' + os.path.basename(imagefile) + '</th>' + \
+		'<td>{}</td><td>{}</td><td>{:.2f}</td>'.format(n_full, n_overlap, seconds_full)
+	for recalled, n, seconds in results:
+		row += '<td>{}</td><td>{}</td><td>{:.2f}</td>'.format(recalled, n, seconds)
+	kept, seconds = triage
+	row += '<td>{}</td><td>{:.2f}</td>'.format('detect' if kept else 'skip', seconds)
+	return row + '</tr>\n'
+
+def eval_pages(imagefiles):
+	header = '<tr><th>page</th><th>full</th><th>overlapping</th><th>seconds</th>' + \
+		''.join(['<th>recalled at {0}x</th><th>found at {0}x</th><th>seconds</th>'.format(scale) \
+			for scale in scales]) + '<th>triage</th><th>seconds</th></tr>\n'
+	rows = ''
+	n_full_total = 0
+	n_overlap_total = 0
+	seconds_full_total = 0
+	recalled_totals = [0] * len(scales)
+	seconds_totals = [0] * len(scales)
+	n_pages = 0
+	n_pages_signs = 0
+	n_pages_kept = 0
+	n_skipped = 0
+	n_lost = 0
+	for imagefile in imagefiles:
+		with profiling.profile(os.path.abspath(imagefile)):
+			n_full, n_overlap, seconds_full, results, triage = eval_page(imagefile)
+		rows += eval_row(imagefile, n_full, n_overlap, seconds_full, results, triage)
+		kept, _ = triage
+		n_pages += 1
+		if n_full > 0:
+			n_pages_signs += 1
+			n_pages_kept += kept
+		if not kept:
+			n_skipped += 1
+			n_lost += n_full
+		n_full_total += n_full
+		n_overlap_total += n_overlap
+		seconds_full_total += seconds_full
+		for i, (recalled, _, seconds) in enumerate(results):
+			recalled_totals[i] += recalled
+			seconds_totals[i] += seconds
+	table = '<table>\n' + header + rows + '</table>\n'
+	summary = '<p>Overlapping pairs of rectangles at full resolution: {}</p>\n'.format(n_overlap_total)
+	for scale, recalled, seconds in zip(scales, recalled_totals, seconds_totals):
+		recall = recalled / n_full_total if n_full_total > 0 else 1
+		speedup = seconds_full_total / seconds if seconds > 0 else 0
+		summary += '<p>Scale {}: recall {:3.4f} [{} of {}], speedup {:.1f}</p>\n'.format( \
+			scale, recall, recalled, n_full_total, speedup)
+	recall = n_pages_kept / n_pages_signs if n_pages_signs > 0 else 1
+	summary += '<p>Triage: recall {:3.4f} [{} of {} pages with signs], skipped {} of {} pages, ' \
+		'losing {} rectangles</p>\n'.format(recall, n_pages_kept, n_pages_signs, n_skipped, n_pages, n_lost)
+	return table + summary
+
+def store_html(body):
+	html = preamble + body + postamble
+	html_file = os.path.join(target_dir, eval_name)
+	with open(html_file, 'w') as handle:
+		handle.write(html)
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print('Arguments are images or directories of images')
+		sys.exit(-1)
+	if not os.path.exists(target_dir):
+		os.mkdir(target_dir)
+	store_html(eval_pages(image_files(sys.argv[1:])))
+	profiling.merge()
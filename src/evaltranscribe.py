@@ -8,13 +8,20 @@ from train import default_sign_model_dir
 from transcribe import FontInfo, image_to_encoding
 from imageprocessing import normalize_image
 from ocrresults import prepare_transcription_dir
+import profiling
 
 test_dir = 'tests'
 target_dir = 'transcriptions'
 cutout_dir = 'evalcutouts'
 eval_name = 'eval.html'
 model_dir = default_sign_model_dir
-fontinfo = FontInfo(model_dir)
+fontinfo = None
+
+def get_fontinfo():
+	global fontinfo
+	if fontinfo is None:
+		fontinfo = FontInfo(model_dir)
+	return fontinfo
 
 preamble = """<html>
 <head>
@@ -57,7 +64,7 @@ def hiero_span(h, correct):
 	return f'<span class="{cl}" style="font-size: 30px;" data-bracketcolor="blue" data-sep="0.15">' + h + '</span>'
 
 def eval_row(label, im, cutout_file, truth):
-	trans = image_to_encoding(im, fontinfo, dir='h')
+	trans = image_to_encoding(im, get_fontinfo(), dir='h')
 	n = len(truth)
 	hits = max(n - distance(truth, trans), 0)
 	correct = (truth == trans)
@@ -95,7 +102,7 @@ def eval_test_row(name, truth):
 	rel = os.path.join(cutout_dir, name)
 	shutil.copy(path, cpy)
 	im = normalize_image(Image.open(path))
-	trans = image_to_encoding(im, fontinfo, dir='h')
+	trans = image_to_encoding(im, get_fontinfo(), dir='h')
 	n = len(truth)
 	hits = max(n - distance(truth, trans), 0)
 	correct = (truth == trans)
@@ -178,4 +185,6 @@ def do_tests():
 
 if __name__ == '__main__':
 	# do_pages()
-	do_tests()
+	with profiling.profile('evaltranscribe'):
+		do_tests()
+	profiling.merge()
@@ -1,67 +1,118 @@
 import sys
 import os
 import pickle
-import heapq
 import json
 import csv
+import hashlib
+import copy
+import time
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from statistics import median
-from PIL import Image, ImageDraw
+from PIL import ImageDraw
 
-from train import default_sign_letter_model_dir, default_sign_model_dir
-from imageprocessing import area, image_to_vec, squared_dist_with_aspect
-from segments import Segment, image_to_segments, MIN_SEGMENT_AREA, MIN_BLACK_AREA
-from rectangleselection import open_selector
+from train import default_sign_letter_model_dir, default_sign_model_dir, discriminator_scores, \
+		model_fingerprint
+from imageprocessing import Projection, area, image_to_vec, closest_with_aspect, reduce_darkest
+from segments import Segment, SpatialGrid, image_to_segments, image_to_components, rects_to_rect, \
+		segments_to_rect, MIN_SEGMENT_AREA, MIN_BLACK_AREA
 from transcribe import FontInfo as SignFontInfo, image_to_encoding
+from calibration import profile_unit_height
+from simpleocr import estimate_median_height
+from azure import AzurePage
+import imageprocessing
+import instrument
+import budget
+import pageio
 
 BLACK_THRESHOLD = 110
+MIN_PARALLEL = 4
+LAYOUT_CONFIDENCE = 0.95
+LAYOUT_MARGIN = 0.02
+TRIAGE_SCALE = 4
+TRIAGE_BATCH = 64
+
+triage_log_name = 'triage.log'
+
+sign_fontinfos = {}
+sign_letter_fontinfos = {}
+
+# Switched off in processes that are themselves among parallel workers.
+parallel_transcription = True
+transcription_pool = None
 
 class FontInfo:
 	def __init__(self, model_dir, unit_height=None):
 		with open(os.path.join(model_dir, 'issign.pickle'), 'rb') as handle:
 			self.issign = pickle.load(handle)
 		with open(os.path.join(model_dir, 'embeddings.pickle'), 'rb') as handle:
-			self.embeddings = pickle.load(handle)
+			self.embeddings = np.asarray(pickle.load(handle))
 		with open(os.path.join(model_dir, 'aspects.pickle'), 'rb') as handle:
-			self.aspects = pickle.load(handle)
-		with open(os.path.join(model_dir, 'scaler.pickle'), 'rb') as handle:
-			self.scaler = pickle.load(handle)
-		with open(os.path.join(model_dir, 'pca.pickle'), 'rb') as handle:
-			self.pca = pickle.load(handle)
+			self.aspects = np.asarray(pickle.load(handle))
+		self.projection = Projection(model_dir)
+		discriminator_file = os.path.join(model_dir, 'discriminator.pickle')
+		if os.path.exists(discriminator_file):
+			with open(discriminator_file, 'rb') as handle:
+				self.discriminator = pickle.load(handle)
+		else:
+			self.discriminator = None
 		self.unit_height = unit_height
 
 	def image_to_embedding(self, im):
 		vec = image_to_vec(im)
-		scaled = self.scaler.transform([vec])[0]
-		embedding = self.pca.transform([scaled])[0]
-		return embedding
-
-def closest_shape_is_sign(embedding, w, h, fontinfo):
-	dists = [squared_dist_with_aspect(embedding, w, h, e, a) for \
-			(e, a) in zip(fontinfo.embeddings, fontinfo.aspects)]
-	indexes = heapq.nlargest(1, range(len(dists)), key=lambda i: -dists[i])
-	return fontinfo.issign[indexes[0]]
-
-def classify_image(im, fontinfo, pruned=False):
-	embedding = fontinfo.image_to_embedding(im)
-	w, h = im.size
-	rel_width = w / fontinfo.unit_height
-	rel_height = h / fontinfo.unit_height
-	if rel_width < 0.5 or rel_height < 0.5:
-		return False
-	elif rel_height > 3:
-		return False
-	elif pruned and rel_height <= 1.9:
-		return False
-	else:
-		return closest_shape_is_sign(embedding, w, h, fontinfo)
+		return self.projection.transform([vec])[0]
 
-def close_to(segment1, segment2, unit):
-	x1 = segment1.x
-	y1 = segment1.y
-	x2 = segment2.x
-	y2 = segment2.y
-	w1, h1 = segment1.im.size
-	w2, h2 = segment2.im.size
+	def images_to_embeddings(self, ims):
+		vecs = np.array([image_to_vec(im) for im in ims])
+		return self.projection.transform(vecs)
+
+# For each embedding, whether the closest prototype with similar aspect is a sign.
+def closest_shapes_are_signs(embeddings, aspects, fontinfo):
+	indexes = closest_with_aspect(embeddings, aspects, fontinfo.embeddings, fontinfo.aspects)
+	return [fontinfo.issign[i] for i in indexes]
+
+# Fast decision by linear discriminator, or None if too close to decision boundary.
+def discriminate_signs(embeddings, aspects, fontinfo):
+	discriminator = fontinfo.discriminator
+	scores = discriminator_scores(embeddings, aspects, discriminator)
+	return [score > 0 if abs(score) >= discriminator['margin'] else None for score in scores]
+
+def plausible_size(w, h, unit):
+	rel_width = w / unit
+	rel_height = h / unit
+	return rel_width >= 0.5 and 0.5 <= rel_height and rel_height <= 3
+
+def plausible_size_pruned(w, h, unit):
+	return plausible_size(w, h, unit) and h / unit > 1.9
+
+# Classify all segments at once, embedding them in a single batch. Returns verdicts
+# for pruned and unpruned classification.
+def classify_segments(segments, fontinfo):
+	unit = fontinfo.unit_height
+	candidates = [i for i, s in enumerate(segments) if plausible_size(s.w, s.h, unit)]
+	pruned = [False] * len(segments)
+	unpruned = [False] * len(segments)
+	if len(candidates) > 0:
+		embeddings = fontinfo.images_to_embeddings([segments[i].im for i in candidates])
+		aspects = np.array([segments[i].w / segments[i].h for i in candidates])
+		if fontinfo.discriminator is not None:
+			verdicts = discriminate_signs(embeddings, aspects, fontinfo)
+		else:
+			verdicts = [None] * len(candidates)
+		undecided = [k for k, verdict in enumerate(verdicts) if verdict is None]
+		instrument.count('segments_classified', len(candidates))
+		instrument.count('prototypes_scanned', len(undecided) * len(fontinfo.embeddings))
+		if len(undecided) > 0:
+			issigns = closest_shapes_are_signs(embeddings[undecided], aspects[undecided], fontinfo)
+			for k, issign in zip(undecided, issigns):
+				verdicts[k] = issign
+		for i, issign in zip(candidates, verdicts):
+			unpruned[i] = issign
+			pruned[i] = issign and plausible_size_pruned(segments[i].w, segments[i].h, unit)
+	return pruned, unpruned
+
+def close_to_rect(x1, y1, w1, h1, x2, y2, w2, h2, unit):
 	y_min = min(y1, y2)
 	y_max = max(y1+h1, y2+h2)
 	if y_max - y_min > 3 * unit:
@@ -70,51 +121,78 @@ def close_to(segment1, segment2, unit):
 		return x2 < x1+w1+2*unit and x1 < x2+w2+2*unit and y1 < y2+h2 and y2 < y1+h1 or \
 			y2 < y1+h1+2*unit and y1 < y2+h2+2*unit and x1 < x2+w2 and x2 < x1+w1
 
-def close_to_any(segment1, segments, unit):
-	for segment2 in segments:
-		if close_to(segment1, segment2, unit):
-			return True
-	return False
+def close_to(segment1, segment2, unit):
+	return close_to_rect(segment1.x, segment1.y, segment1.w, segment1.h, \
+		segment2.x, segment2.y, segment2.w, segment2.h, unit)
 
-def find_signs(im, model_dir):
-	segments = image_to_segments(im, BLACK_THRESHOLD, strict=True, \
-			min_area=MIN_SEGMENT_AREA, min_black_area=MIN_BLACK_AREA)
-	segments = sorted(segments, key=lambda s: s.y)
-	heights = [segment.h for segment in segments]
-	unit_height = median(heights)
-	fontinfo = FontInfo(model_dir, unit_height)
-	signs = []
-	i = 0
-	while i < len(segments):
-		if classify_image(segments[i].im, fontinfo, pruned=True):
-			signs.append(segments.pop(i))
-		else:
-			i += 1
-	changed = len(signs) > 0
+# Starting from the signs, repeatedly add segments that are close to a sign and that
+# are classified as signs themselves, going through the segments in order in rounds until
+# none is added. Only signs in neighbouring cells are checked. Returns indices of added
+# segments in order of addition.
+def grow_signs(segments, is_sign, classified_sign, unit):
+	grid = SpatialGrid([(s.x, s.y, s.w, s.h) for s in segments], 2 * unit)
+	candidates = [i for i in range(len(segments)) if classified_sign[i] and not is_sign[i]]
+	grown = []
+	changed = True
 	while changed:
 		changed = False
-		i = 0
-		while i < len(segments):
-			segment = segments[i]
-			if close_to_any(segment, signs, fontinfo.unit_height) and classify_image(segment.im, fontinfo):
-				signs.append(segments.pop(i))
+		for j in candidates:
+			segment = segments[j]
+			if not is_sign[j] and any(is_sign[k] and close_to(segment, segments[k], unit) \
+					for k in grid.near(segment.x, segment.y, segment.w, segment.h, 2 * unit)):
+				is_sign[j] = True
+				grown.append(j)
 				changed = True
-			else:
-				i += 1
-	changed = len(signs) > 0
+	return grown
+
+# Group signs that are close to one another. Each sign in turn, unless it was taken by an earlier
+# one, takes later signs close to its group, judged by the bounding box of the group so far,
+# until no more groups are joined. Pixels are merged once per group.
+def cluster_signs(signs, unit):
+	clusters = [[sign] for sign in signs]
+	rects = [(sign.x, sign.y, sign.w, sign.h) for sign in signs]
+	changed = len(rects) > 1
 	while changed:
 		changed = False
-		i = 0
-		while i < len(signs):
-			j = i+1
-			while j < len(signs):
-				if close_to(signs[i], signs[j], unit_height):
-					signs[i] = Segment.merge(signs[i], signs[j])
-					signs.pop(j)
-					changed = True
-				else:
-					j += 1
-			i += 1
+		grid = SpatialGrid(rects, 2 * unit)
+		taken = [False] * len(rects)
+		groups = []
+		for i in range(len(rects)):
+			if taken[i]:
+				continue
+			group = [i]
+			group_rect = rects[i]
+			j = i
+			while True:
+				later = [k for k in grid.near(*group_rect, 2 * unit) \
+					if k > j and not taken[k] and close_to_rect(*group_rect, *rects[k], unit)]
+				if len(later) == 0:
+					break
+				j = later[0]
+				taken[j] = True
+				group.append(j)
+				group_rect = rects_to_rect([group_rect, rects[j]])
+				changed = True
+			groups.append(group)
+		clusters = [[sign for i in group for sign in clusters[i]] for group in groups]
+		rects = [rects_to_rect([rects[i] for i in group]) for group in groups]
+	return [Segment.merge_many(cluster) for cluster in clusters]
+
+@instrument.timed('find_signs')
+def find_signs(im, model_dir, unit_height=None, speckle_size=None):
+	segments = image_to_segments(im, BLACK_THRESHOLD, strict=True, \
+			min_area=MIN_SEGMENT_AREA, min_black_area=MIN_BLACK_AREA, speckle_size=speckle_size)
+	instrument.count('components', len(segments))
+	segments = sorted(segments, key=lambda s: s.y)
+	if unit_height is None:
+		heights = [segment.h for segment in segments]
+		unit_height = median(heights)
+	fontinfo = get_sign_letter_fontinfo(model_dir, unit_height)
+	pruned, unpruned = classify_segments(segments, fontinfo)
+	is_sign = list(pruned)
+	grown = grow_signs(segments, is_sign, unpruned, unit_height)
+	seeds = [i for i in range(len(segments)) if pruned[i]]
+	signs = cluster_signs([segments[i] for i in seeds + grown], unit_height)
 	rects = []
 	for segment in signs:
 		x = segment.x
@@ -123,29 +201,267 @@ def find_signs(im, model_dir):
 		rects.append((x, y, w, h))
 	return rects
 
+# Number of segments of reduced page that could start a group of signs in find_signs, at most limit.
+# Thresholds and unit height (if given, at full resolution) are scaled down with the page;
+# the minimum fraction of black pixels does not depend on the scale. Without unit height, all
+# components are needed for their median height; otherwise components are generated lazily.
+# Segments are made and classified in batches, and counting stops once limit is reached.
+def count_sign_candidates(im, model_dir, scale=TRIAGE_SCALE, limit=None, unit_height=None):
+	reduced = reduce_darkest(im, scale)
+	components = image_to_components(reduced, BLACK_THRESHOLD, strict=True, \
+			min_area=MIN_SEGMENT_AREA / scale**2, min_black_area=MIN_BLACK_AREA)
+	if unit_height is None:
+		components = list(components)
+		if len(components) == 0:
+			return 0
+		unit_height = median([component.bbox()[3] for component in components])
+	else:
+		unit_height = unit_height / scale
+	components = (c for c in components if plausible_size_pruned(*c.bbox()[2:], unit_height))
+	fontinfo = get_sign_letter_fontinfo(model_dir, unit_height)
+	n_candidates = 0
+	while limit is None or n_candidates < limit:
+		batch = list(itertools.islice(components, TRIAGE_BATCH))
+		if len(batch) == 0:
+			break
+		pruned, _ = classify_segments([Segment.from_component(c) for c in batch], fontinfo)
+		n_candidates += sum(pruned)
+	return n_candidates if limit is None else min(n_candidates, limit)
+
+# Whether page may contain hieroglyphic. Decision is logged in directory of page.
+def triage_page(imagefile, im, model_dir=default_sign_letter_model_dir):
+	start = time.time()
+	n_candidates = count_sign_candidates(im, model_dir, limit=1)
+	seconds = time.time() - start
+	decision = 'detect' if n_candidates > 0 else 'skip'
+	logfile = os.path.join(os.path.dirname(os.path.abspath(imagefile)), triage_log_name)
+	with open(logfile, 'a') as handle:
+		handle.write('{}\t{}\t{}\t{:.3f}\n'.format(os.path.basename(imagefile), n_candidates, decision, seconds))
+	return n_candidates > 0
+
+def write_empty_csv(imagefile):
+	with open(imagefile + '.csv', 'w') as handle:
+		pass
+
 def manual_adjust(imagefile, im, rects):
+	from rectangleselection import open_selector
 	segments = [Segment.from_rectangle(x, y, w, h) for x, y, w, h in rects]
 	open_selector(imagefile, segments, \
 			lambda segments: store_rectangles(imagefile, im, segments))
 
+# Model distinguishing signs from letters, with given unit height. The model is kept in memory,
+# and loaded again only if retrained.
+def get_sign_letter_fontinfo(model_dir=default_sign_letter_model_dir, unit_height=None):
+	fingerprint = model_fingerprint(model_dir)
+	if model_dir not in sign_letter_fontinfos or sign_letter_fontinfos[model_dir][0] != fingerprint:
+		sign_letter_fontinfos[model_dir] = (fingerprint, FontInfo(model_dir))
+	fontinfo = copy.copy(sign_letter_fontinfos[model_dir][1])
+	fontinfo.unit_height = unit_height
+	return fontinfo
+
+# Sign model, loaded again only if retrained.
+def get_sign_fontinfo(model_dir=default_sign_model_dir):
+	fingerprint = model_fingerprint(model_dir)
+	if model_dir not in sign_fontinfos or sign_fontinfos[model_dir][0] != fingerprint:
+		sign_fontinfos[model_dir] = (fingerprint, SignFontInfo(model_dir))
+	return sign_fontinfos[model_dir][1]
+
+def transcribe_subimage(subimage):
+	return image_to_encoding(subimage, get_sign_fontinfo())
+
+# Transcription under deadline of page, possibly in pool process, together with the stages it degraded.
+def transcribe_subimage_part(args):
+	subimage, deadline = args
+	with budget.page_part(deadline) as degraded:
+		hiero = transcribe_subimage(subimage)
+	return hiero, degraded
+
+# Pool of processes with sign model loaded, started at first use and kept for the session,
+# so that saving again does not start processes and load models again.
+def get_transcription_pool():
+	global transcription_pool
+	if transcription_pool is None:
+		transcription_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=get_sign_fontinfo)
+	return transcription_pool
+
+# Few rectangles, typically those changed since the last save, are transcribed in this process.
+# Gives per key the transcription and whether it was degraded for lack of time. Stages degraded
+# in pool processes are recorded for the page in this process.
+def transcribe_subimages(key_to_subimage):
+	keys = list(key_to_subimage.keys())
+	tasks = [(key_to_subimage[key], budget.page_deadline) for key in keys]
+	if parallel_transcription and len(tasks) >= MIN_PARALLEL:
+		results = list(get_transcription_pool().map(transcribe_subimage_part, tasks))
+	else:
+		results = [transcribe_subimage_part(task) for task in tasks]
+	transcriptions = {}
+	for key, (hiero, degraded) in zip(keys, results):
+		budget.add_degraded(degraded)
+		transcriptions[key] = (hiero, 'parts' in degraded)
+	return transcriptions
+
+def rectangle_key(segment, subimage):
+	digest = hashlib.sha1(subimage.tobytes()).hexdigest()
+	return '{} {} {} {} {}'.format(segment.x, segment.y, segment.w, segment.h, digest)
+
+# Earlier transcriptions of rectangles, next to csv file, and transcriptions that were degraded
+# for lack of time, which are to be done again. Discarded if sign model changed.
+def read_transcription_cache(csvfile, fingerprint):
+	cachefile = csvfile + '.cache'
+	if os.path.exists(cachefile):
+		with open(cachefile, 'r') as handle:
+			cache = json.load(handle)
+		if cache['model'] == fingerprint:
+			return cache['hieros'], cache.get('degraded', {})
+	return {}, {}
+
+def write_transcription_cache(csvfile, fingerprint, key_to_hiero, key_to_degraded):
+	cachefile = csvfile + '.cache'
+	with open(cachefile, 'w') as handle:
+		json.dump({'model': fingerprint, 'hieros': key_to_hiero, 'degraded': key_to_degraded}, handle)
+
+# Transcribe rectangles, keeping those that were not degraded in cache, and the others apart.
+def transcribe_into(cache, degraded, key_to_subimage):
+	for key, (hiero, is_degraded) in transcribe_subimages(key_to_subimage).items():
+		if is_degraded:
+			degraded[key] = hiero
+		else:
+			cache[key] = hiero
+
+def write_csv_rows(csvfile, rows):
+	with open(csvfile, "w") as handle:
+		writer = csv.writer(handle, delimiter=' ')
+		for row in rows:
+			writer.writerow(row)
+
+# Only rectangles that are new, whose pixels changed, or whose transcription was degraded
+# are transcribed.
 def store_rectangles(imagefile, im, segments):
-	sign_fontinfo = SignFontInfo(default_sign_model_dir)
 	csvfile = imagefile + '.csv'
+	fingerprint = model_fingerprint(default_sign_model_dir)
+	cache, _ = read_transcription_cache(csvfile, fingerprint)
+	degraded = {}
+	subimages = [segment.cut_from_page(im) for segment in segments]
+	keys = [rectangle_key(segment, subimage) for segment, subimage in zip(segments, subimages)]
+	transcribe_into(cache, degraded, {key: subimage for key, subimage in zip(keys, subimages) if key not in cache})
+	write_transcription_cache(csvfile, fingerprint, {key: cache[key] for key in keys if key in cache}, degraded)
 	rows = []
-	for segment in segments:
+	for segment, key in zip(segments, keys):
+		hiero = cache[key] if key in cache else degraded[key]
+		rows.append([segment.x, segment.y, segment.w, segment.h, hiero])
+	write_csv_rows(csvfile, sorted(rows, key=lambda row: row[1]))
+
+# Rows of csv file whose transcription was degraded for lack of time are transcribed again,
+# unless corrected by hand since. Other rows are left as they are.
+def retranscribe_degraded(imagefile, im):
+	csvfile = imagefile + '.csv'
+	fingerprint = model_fingerprint(default_sign_model_dir)
+	cache, degraded = read_transcription_cache(csvfile, fingerprint)
+	if len(degraded) == 0:
+		return
+	with open(csvfile) as handle:
+		rows = list(csv.reader(handle, delimiter=' '))
+	keys = []
+	todo = {}
+	for x, y, w, h, hiero in rows:
+		segment = Segment.from_rectangle(int(x), int(y), int(w), int(h))
 		subimage = segment.cut_from_page(im)
-		hiero = image_to_encoding(subimage, sign_fontinfo)
-		rows.append({'x': segment.x, 'y': segment.y, 'w': segment.w, 'h': segment.h, 'hiero': hiero})
-	rows = sorted(rows, key=lambda row: row['y'])
-	with open(csvfile, "w") as handle:
-		writer = csv.writer(handle, delimiter=' ')
-		for row in rows:
-			writer.writerow([row['x'], row['y'], row['w'], row['h'], row['hiero']])
+		key = rectangle_key(segment, subimage)
+		keys.append(key)
+		if degraded.get(key) == hiero:
+			todo[key] = subimage
+	still_degraded = {}
+	transcribe_into(cache, still_degraded, todo)
+	write_transcription_cache(csvfile, fingerprint, cache, still_degraded)
+	for row, key in zip(rows, keys):
+		if key in todo:
+			row[4] = cache[key] if key in cache else still_degraded[key]
+	write_csv_rows(csvfile, rows)
+
+# Shrink rectangle found at reduced scale to segments at full resolution within it.
+# Segments cut off by the edge of the region are left out, unless that edge is the edge of the page.
+def refine_rect(im, x, y, w, h, margin):
+	page_w, page_h = im.size
+	x_min = max(0, x - margin)
+	y_min = max(0, y - margin)
+	x_max = min(page_w, x + w + margin)
+	y_max = min(page_h, y + h + margin)
+	region = im.crop((x_min, y_min, x_max, y_max))
+	segments = image_to_segments(region, BLACK_THRESHOLD, strict=True, min_area=MIN_SEGMENT_AREA)
+	segments = [s for s in segments if (s.x > 0 or x_min == 0) and (s.y > 0 or y_min == 0) and \
+		(s.x + s.w < x_max - x_min or x_max == page_w) and (s.y + s.h < y_max - y_min or y_max == page_h)]
+	if len(segments) == 0:
+		return x, y, w, h
+	x_seg, y_seg, w_seg, h_seg = segments_to_rect(segments)
+	return x_seg + x_min, y_seg + y_min, w_seg, h_seg
 
-def find_hiero_in_page(imagefile):
-	im = Image.open(imagefile)
-	rects = find_signs(im, default_sign_letter_model_dir)
-	rects = manual_adjust(imagefile, im, rects)
+# Find signs at reduced scale, and refine rectangles at full resolution.
+def find_signs_reduced(im, model_dir, scale, unit_height=None, speckle_size=None):
+	reduced = im.convert('L').reduce(scale)
+	reduced_unit_height = unit_height / scale if unit_height is not None else None
+	reduced_speckle_size = max(1, speckle_size // scale) if speckle_size is not None else None
+	rects = find_signs(reduced, model_dir, unit_height=reduced_unit_height, speckle_size=reduced_speckle_size)
+	return [refine_rect(im, x * scale, y * scale, w * scale, h * scale, scale) for x, y, w, h in rects]
+
+def detect_signs(im, model_dir, unit_height=None, scale=1, speckle_size=None):
+	if scale > 1:
+		return find_signs_reduced(im, model_dir, scale, unit_height=unit_height, speckle_size=speckle_size)
+	else:
+		return find_signs(im, model_dir, unit_height=unit_height, speckle_size=speckle_size)
+
+# Whiten words that OCR read with high confidence, and crop to the text block with margin.
+# Returns masked image with its offset in the page, and words that were whitened.
+def mask_text(im, page):
+	masked = im.copy()
+	drawing = ImageDraw.Draw(masked)
+	words = [word for line in page.lines for word in line.words if word.confidence >= LAYOUT_CONFIDENCE]
+	for word in words:
+		drawing.rectangle([(word.x, word.y), (word.x+word.w-1, word.y+word.h-1)], fill='white')
+	w, h = im.size
+	x, y, text_w, text_h = page.text_corners
+	x_min = max(0, round(x - LAYOUT_MARGIN * w))
+	y_min = max(0, round(y - LAYOUT_MARGIN * h))
+	x_max = min(w, round(x + text_w + LAYOUT_MARGIN * w))
+	y_max = min(h, round(y + text_h + LAYOUT_MARGIN * h))
+	return masked.crop((x_min, y_min, x_max, y_max)), x_min, y_min, words
+
+# Find signs only in parts of page not confidently read as text by OCR.
+def find_signs_outside_text(imagefile, im, model_dir, unit_height=None, scale=1, speckle_size=None):
+	page = AzurePage(imagefile)
+	masked, x_offset, y_offset, words = mask_text(im, page)
+	if unit_height is None:
+		unit_height, _, _ = estimate_median_height(im, words=words)
+	rects = detect_signs(masked, model_dir, unit_height=unit_height, scale=scale, speckle_size=speckle_size)
+	return [(x + x_offset, y + y_offset, w, h) for x, y, w, h in rects]
+
+# Outside text, the unit height is that of the words, which the calibration profile holds.
+# Otherwise find_signs takes the median height of its own segments, as the profile would
+# hold a different statistic.
+def find_hiero_rects(imagefile, im, layout=False, scale=1, speckle_size=None):
+	if layout and os.path.exists(imagefile + '.json'):
+		unit_height = profile_unit_height(imagefile, im)
+		return find_signs_outside_text(imagefile, im, default_sign_letter_model_dir, \
+			unit_height=unit_height, scale=scale, speckle_size=speckle_size)
+	else:
+		return detect_signs(im, default_sign_letter_model_dir, scale=scale, speckle_size=speckle_size)
+
+def find_hiero_in_page(imagefile, interactive=True, layout=False, scale=1, speckle_size=None):
+	im = pageio.open_image(imagefile)
+	rects = find_hiero_rects(imagefile, im, layout=layout, scale=scale, speckle_size=speckle_size)
+	if interactive:
+		manual_adjust(imagefile, im, rects)
+	else:
+		segments = [Segment.from_rectangle(x, y, w, h) for x, y, w, h in rects]
+		store_rectangles(imagefile, im, segments)
+
+def image_files(paths):
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			files.extend(sorted([os.path.join(path, f) for f in os.listdir(path) if f.endswith('.png')]))
+		else:
+			files.append(path)
+	return files
 
 def add_rects_to_image(im, rects):
 	result = im.convert('RGB')
@@ -156,9 +472,32 @@ def add_rects_to_image(im, rects):
 
 if __name__ == '__main__':
 	imagefile = '/home/mn31/work/topbib/topbib/ocr/vol1/1.png'
-	if len(sys.argv) >= 2:
-		imagefile = sys.argv[1]
-	find_hiero_in_page(imagefile)
+	args = sys.argv[1:]
+	layout = '--layout' in args
+	args = [arg for arg in args if arg != '--layout']
+	scale = 1
+	if '--scale' in args:
+		i = args.index('--scale')
+		scale = int(args[i+1])
+		args = args[:i] + args[i+2:]
+	speckle_size = None
+	if '--speckle' in args:
+		i = args.index('--speckle')
+		speckle_size = int(args[i+1])
+		args = args[:i] + args[i+2:]
+	if '--verbose' in args:
+		imageprocessing.verbose_speckles = True
+		args.remove('--verbose')
+	if len(args) >= 2 and args[0] == '--batch':
+		for imagefile in image_files(args[1:]):
+			if not os.path.isfile(imagefile + '.csv'):
+				print('Finding hieroglyphic in', imagefile)
+				find_hiero_in_page(imagefile, interactive=False, layout=layout, scale=scale, \
+					speckle_size=speckle_size)
+		sys.exit(0)
+	if len(args) >= 1:
+		imagefile = args[0]
+	find_hiero_in_page(imagefile, layout=layout, scale=scale, speckle_size=speckle_size)
 	# im = Image.open(imagefile)
 	# rects = find_signs(im, default_sign_letter_model_dir)
 	# rects = manual_adjust(imagefile, im, rects)
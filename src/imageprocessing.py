@@ -1,14 +1,22 @@
 from PIL import Image, ImageChops
 import numpy as np
 import math
+import os
 import sys
+import pickle
 import statistics
+import heapq
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 binarize = False
 block_prototype = True
+verbose_speckles = False
 
 BLACK_THRESHOLD = 128
 GRID_SIZE = 64
+TILE_SIZE = 2048
+MAX_UNTILED_AREA = 40000000
 
 def normalize_image(im):
 	if binarize:
@@ -57,13 +65,16 @@ def n_black(im, threshold):
 				n += 1
 	return n
 
-def aspects_similar(aspect1, aspect2):
-	if aspect1 < 0.3 or 1/aspect1 < 0.3:
-		return abs(aspect1-aspect2) / aspect1 < 0.3
-	elif aspect1 < 0.5 or 1/aspect1 < 0.5:
-		return abs(aspect1-aspect2) / aspect1 < 0.2
+def aspect_tolerance(aspect):
+	if aspect < 0.3 or 1/aspect < 0.3:
+		return 0.3
+	elif aspect < 0.5 or 1/aspect < 0.5:
+		return 0.2
 	else:
-		return abs(aspect1-aspect2) / aspect1 < 0.1
+		return 0.1
+
+def aspects_similar(aspect1, aspect2):
+	return abs(aspect1-aspect2) / aspect1 < aspect_tolerance(aspect1)
 
 def sizes_similar(s1, s2):
 	return (s1 > 0.25 or s2 < 0.75) and (s2 > 0.25 or s1 < 0.75)
@@ -90,12 +101,65 @@ def squared_dist_with_aspect_height(vals1, aspect1, height1, vals2, aspect2, hei
 	else:
 		return sys.float_info.max
 
+# For each embedding, index of closest prototype with similar aspect, computed in batches.
+# If exclude_self, the embeddings are the prototypes themselves and each is not its own match.
+def closest_with_aspect(embeddings, aspects, prototypes, prototype_aspects, exclude_self=False, \
+		batch_size=256):
+	prototype_norms = (prototypes ** 2).sum(axis=1)
+	indexes = []
+	for start in range(0, len(embeddings), batch_size):
+		batch = embeddings[start:start+batch_size]
+		batch_aspects = aspects[start:start+batch_size]
+		dists = (batch ** 2).sum(axis=1)[:,None] - 2 * batch @ prototypes.T + prototype_norms[None,:]
+		tolerances = np.array([aspect_tolerance(aspect) for aspect in batch_aspects])
+		similar = np.abs(batch_aspects[:,None] - prototype_aspects[None,:]) / batch_aspects[:,None] < \
+			tolerances[:,None]
+		dists = np.where(similar, dists, np.inf)
+		if exclude_self:
+			rows = np.arange(len(batch))
+			dists[rows, start + rows] = np.inf
+		indexes.extend(np.argmin(dists, axis=1))
+	return indexes
+
 def image_to_vec(im):
 	if block_prototype:
 		return image_to_vec_block(im)
 	else:
 		return image_to_vec_unused(im)
 
+projection_name = 'projection.npz'
+
+# Standardization followed by PCA, as fitted in training, applied with NumPy only.
+# Models trained before projections were exported still have the pickled scaler and PCA,
+# whose arrays are taken over; unpickling these requires scikit-learn.
+class Projection:
+	def __init__(self, model_dir):
+		filename = os.path.join(model_dir, projection_name)
+		if os.path.exists(filename):
+			with np.load(filename) as arrays:
+				self.scale_mean = arrays['scale_mean']
+				self.scale = arrays['scale']
+				self.pca_mean = arrays['pca_mean']
+				self.components = arrays['components']
+		else:
+			with open(os.path.join(model_dir, 'scaler.pickle'), 'rb') as handle:
+				scaler = pickle.load(handle)
+			with open(os.path.join(model_dir, 'pca.pickle'), 'rb') as handle:
+				pca = pickle.load(handle)
+			self.scale_mean = scaler.mean_
+			self.scale = scaler.scale_
+			self.pca_mean = pca.mean_
+			self.components = pca.components_
+
+	@staticmethod
+	def save(model_dir, scale_mean, scale, pca_mean, components):
+		np.savez(os.path.join(model_dir, projection_name), scale_mean=scale_mean, scale=scale, \
+			pca_mean=pca_mean, components=components)
+
+	def transform(self, vecs):
+		scaled = (np.asarray(vecs, dtype=np.float64) - self.scale_mean) / self.scale
+		return (scaled - self.pca_mean) @ self.components.T
+
 def image_to_vec_block(im):
 	resized = im.resize((GRID_SIZE, GRID_SIZE))
 	vec = np.asarray(resized).flatten()
@@ -117,29 +181,269 @@ def image_to_vec_center(im):
 	vec = np.asarray(block).flatten()
 	return vec
 
-def find_component(im, visited, x, y, threshold, strict=False):
-	component = []
+def visit_white(im, visited, x, y, threshold):
 	w, h = im.size
 	to_visit = [(x,y)]
-	if strict:
-		neighbours = [(-1,0),(1,0),(0,-1),(0,1)]
-	else:
-		neighbours = [(x_diff, y_diff) \
-			for x_diff in [-1,0,1] for y_diff in [-1,0,1] if x_diff != 0 or y_diff != 0]
 	while len(to_visit) > 0:
 		(x1,y1) = to_visit.pop()
-		if is_black(im, x1, y1, threshold) and (x1,y1) not in visited:
+		if is_white(im, x1, y1) and (x1,y1) not in visited:
 			visited.add((x1,y1))
-			component.append((x1, y1, im.getpixel((x1,y1))))
-			for x_diff, y_diff in neighbours:
-				to_visit.append((x1+x_diff,y1+y_diff))
-	return component
+			for x_diff in [-1,0,1]:
+				for y_diff in [-1,0,1]:
+					if x_diff != 0 or y_diff != 0:
+						to_visit.append((x1+x_diff,y1+y_diff))
+
+def image_to_array(im):
+	return np.asarray(im if im.mode == 'L' else im.convert('L'))
+
+# Reduce size by integer factor, keeping darkest pixel of each block, so thin strokes remain.
+def reduce_darkest(im, scale):
+	arr = image_to_array(im)
+	h, w = arr.shape
+	h_reduced = h // scale
+	w_reduced = w // scale
+	blocks = arr[:h_reduced*scale, :w_reduced*scale].reshape(h_reduced, scale, w_reduced, scale)
+	return Image.fromarray(blocks.min(axis=(1, 3)))
+
+# Connected component stored as runs of black pixels within rows, in row-major order.
+# Run i covers pixels x0s[i] up to but excluding x1s[i] in row ys[i]. The gray values
+# of the pixels are concatenated in the same order, one byte per pixel.
+class Component:
+	def __init__(self, ys, x0s, x1s, grays):
+		self.ys = ys
+		self.x0s = x0s
+		self.x1s = x1s
+		self.grays = grays
+
+	def __len__(self):
+		return len(self.grays)
+
+	def __iter__(self):
+		xs, ys = self.pixels()
+		return zip(xs.tolist(), ys.tolist(), self.grays.tolist())
+
+	def bbox(self):
+		x_min = int(self.x0s.min())
+		y_min = int(self.ys[0])
+		return x_min, y_min, int(self.x1s.max()) - x_min, int(self.ys[-1]) + 1 - y_min
+
+	def area(self):
+		_, _, w, h = self.bbox()
+		return w * h
+
+	def n_black(self):
+		return len(self.grays)
+
+	# Pixel with smallest x, and smallest y for equal x.
+	def first(self):
+		i = np.lexsort((self.ys, self.x0s))[0]
+		return int(self.x0s[i]), int(self.ys[i])
+
+	# Coordinates of pixels, in the order of the gray values.
+	def pixels(self):
+		lengths = self.x1s - self.x0s
+		offsets = np.cumsum(lengths) - lengths
+		xs = np.repeat(self.x0s - offsets, lengths) + np.arange(len(self.grays), dtype=np.int32)
+		ys = np.repeat(self.ys, lengths)
+		return xs, ys
+
+	def translate(self, x_diff, y_diff):
+		return Component(self.ys + y_diff, self.x0s + x_diff, self.x1s + x_diff, self.grays)
+
+	def to_array(self):
+		x, y, w, h = self.bbox()
+		arr = np.full((h, w), 255, dtype=np.uint8)
+		xs, ys = self.pixels()
+		arr[ys - y, xs - x] = self.grays
+		return arr
+
+	def to_image(self):
+		im = Image.fromarray(self.to_array())
+		return normalize_image(im) if binarize else im
+
+	@staticmethod
+	def from_runs(ys, x0s, x1s, grays):
+		ys = ys.astype(np.int32)
+		x0s = x0s.astype(np.int32)
+		x1s = x1s.astype(np.int32)
+		order = np.lexsort((x0s, ys))
+		if np.any(order != np.arange(len(order))):
+			lengths = x1s - x0s
+			offsets = np.cumsum(lengths) - lengths
+			new_lengths = lengths[order]
+			new_offsets = np.cumsum(new_lengths) - new_lengths
+			pixel_order = np.repeat(offsets[order] - new_offsets, new_lengths) + np.arange(len(grays))
+			ys, x0s, x1s, grays = ys[order], x0s[order], x1s[order], grays[pixel_order]
+		# Runs touching within a row, as after stitching tiles, become one run.
+		joined = (ys[1:] == ys[:-1]) & (x0s[1:] == x1s[:-1])
+		if np.any(joined):
+			starts = np.concatenate(([True], ~joined))
+			ends = np.concatenate((~joined, [True]))
+			ys, x0s, x1s = ys[starts], x0s[starts], x1s[ends]
+		return Component(ys, x0s, x1s, grays)
+
+	@staticmethod
+	def from_pixels(xs, ys, grays):
+		order = np.lexsort((xs, ys))
+		xs = np.asarray(xs, dtype=np.int32)[order]
+		ys = np.asarray(ys, dtype=np.int32)[order]
+		grays = np.asarray(grays, dtype=np.uint8)[order]
+		starts = np.concatenate(([True], (ys[1:] != ys[:-1]) | (xs[1:] != xs[:-1] + 1)))
+		ends = np.concatenate((starts[1:], [True]))
+		return Component(ys[starts], xs[starts], xs[ends] + 1, grays)
+
+	@staticmethod
+	def merge(components):
+		return Component.from_runs(np.concatenate([c.ys for c in components]), \
+			np.concatenate([c.x0s for c in components]), \
+			np.concatenate([c.x1s for c in components]), \
+			np.concatenate([c.grays for c in components]))
+
+# Maximal runs of pixels in mask within rows, in row-major order,
+# and the gray values of these pixels in the same order.
+def black_runs(arr, mask):
+	h, w = mask.shape
+	padded = np.zeros((h, w+2), dtype=np.int8)
+	padded[:,1:-1] = mask
+	ys, xs = np.nonzero(np.diff(padded, axis=1))
+	return ys[::2].astype(np.int32), xs[::2].astype(np.int32), xs[1::2].astype(np.int32), arr[mask]
 
+# Sums over all windows of given size, from integral image with extra leading row and column of zeros.
+def window_sums(integral, size):
+	return integral[size:,size:] - integral[:-size,size:] - integral[size:,:-size] + integral[:-size,:-size]
+
+def integral_image(mask):
+	h, w = mask.shape
+	integral = np.zeros((h+1, w+1), dtype=np.int32)
+	integral[1:,1:] = mask.cumsum(axis=0, dtype=np.int32).cumsum(axis=1, dtype=np.int32)
+	return integral
+
+# Remove specks: groups of pixels fitting in a window of size by size, surrounded by a ring
+# of white pixels just outside the window. Outside the mask counts as white.
+# Returns cleaned mask and mask of removed pixels.
+def remove_speckles(mask, size):
+	h, w = mask.shape
+	if h < size or w < size:
+		return mask, np.zeros_like(mask)
+	integral = integral_image(np.pad(mask, 1))
+	outer = window_sums(integral, size+2)
+	inner = window_sums(integral, size)[1:h-size+2,1:w-size+2]
+	isolated = (outer == inner) & (inner > 0)
+	covered = window_sums(integral_image(np.pad(isolated, size-1)), size) > 0
+	return mask & ~covered, mask & covered
+
+# Numbers of removed pixels and removed specks within rectangle of mask, where a speck
+# belongs to the rectangle containing its first pixel in row-major order.
+def speck_counts(removed, x_min, y_min, x_max, y_max):
+	ys, x0s, x1s, _ = black_runs(removed, removed)
+	if len(ys) == 0:
+		return 0, 0
+	labels = label_groups(len(ys), *touching_runs(ys, x0s, x1s, False))
+	firsts = np.unique(labels)
+	n_pixels = int(removed[y_min:y_max,x_min:x_max].sum())
+	n_specks = int(np.count_nonzero((ys[firsts] >= y_min) & (ys[firsts] < y_max) & \
+		(x0s[firsts] >= x_min) & (x0s[firsts] < x_max)))
+	return n_pixels, n_specks
+
+# Printed only if asked for, as by --verbose of findhiero.py.
+def report_speckles(n_pixels, n_specks):
+	if verbose_speckles and n_specks > 0:
+		print('Removed', n_pixels, 'pixels in', n_specks, 'specks')
+
+# Pairs of indices of touching runs, given in row-major order. Runs in consecutive rows touch
+# if they overlap, or with diagonal connectivity if they are at most one pixel apart.
+# Runs in the same row touch only if one ends where the other starts.
+def touching_runs(ys, x0s, x1s, strict):
+	if len(ys) == 0:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	slack = 0 if strict else 1
+	ys = ys.astype(np.int64)
+	x0s = x0s.astype(np.int64)
+	x1s = x1s.astype(np.int64)
+	row_size = int(x1s.max()) + 4
+	first = np.searchsorted(ys * row_size + x1s + 2, (ys+1) * row_size + x0s - slack + 2, side='right')
+	last = np.searchsorted(ys * row_size + x0s + 2, (ys+1) * row_size + x1s + slack + 2, side='left')
+	counts = np.maximum(last - first, 0)
+	upper = np.repeat(np.arange(len(ys)), counts)
+	offsets = np.cumsum(counts) - counts
+	lower = np.repeat(first - offsets, counts) + np.arange(counts.sum())
+	same_row = np.nonzero((ys[1:] == ys[:-1]) & (x0s[1:] == x1s[:-1]))[0]
+	return np.concatenate((upper, same_row)), np.concatenate((lower, same_row + 1))
+
+# For n nodes and edges between them, smallest node in the group of each node.
+# Roots are hooked under smaller roots, followed by pointer jumping, until no edge
+# joins different groups.
+def label_groups(n, sources, targets):
+	labels = np.arange(n)
+	while True:
+		source_labels = labels[sources]
+		target_labels = labels[targets]
+		differ = source_labels != target_labels
+		if not np.any(differ):
+			return labels
+		low = np.minimum(source_labels[differ], target_labels[differ])
+		high = np.maximum(source_labels[differ], target_labels[differ])
+		np.minimum.at(labels, high, low)
+		while True:
+			jumped = labels[labels]
+			if np.array_equal(jumped, labels):
+				break
+			labels = jumped
+
+# Split runs into components given group label of each run, ordered by first pixel
+# in order of increasing x, and of increasing y for equal x. Components are generated
+# one at a time, as views on the runs of the page.
+def runs_to_components(ys, x0s, x1s, grays, labels):
+	if len(ys) == 0:
+		return
+	roots, group = np.unique(labels, return_inverse=True)
+	first = np.full(len(roots), np.iinfo(np.int64).max)
+	np.minimum.at(first, group, x0s.astype(np.int64) * (int(ys.max()) + 1) + ys)
+	rank = np.empty(len(roots), dtype=np.int64)
+	rank[np.argsort(first)] = np.arange(len(roots))
+	group = rank[group]
+	lengths = x1s - x0s
+	run_order = np.argsort(group, kind='stable')
+	pixel_order = np.argsort(np.repeat(group, lengths), kind='stable')
+	run_bounds = np.cumsum(np.bincount(group, minlength=len(roots)))
+	pixel_bounds = np.cumsum(np.bincount(group, weights=lengths, minlength=len(roots)).astype(np.int64))
+	ys, x0s, x1s, grays = ys[run_order], x0s[run_order], x1s[run_order], grays[pixel_order]
+	run_start = 0
+	pixel_start = 0
+	for run_end, pixel_end in zip(run_bounds.tolist(), pixel_bounds.tolist()):
+		yield Component(ys[run_start:run_end], x0s[run_start:run_end], \
+			x1s[run_start:run_end], grays[pixel_start:pixel_end])
+		run_start = run_end
+		pixel_start = pixel_end
+
+def mask_to_components(arr, mask, strict=False):
+	ys, x0s, x1s, grays = black_runs(arr, mask)
+	sources, targets = touching_runs(ys, x0s, x1s, strict)
+	labels = label_groups(len(ys), sources, targets)
+	return runs_to_components(ys, x0s, x1s, grays, labels)
+
+def array_to_components(arr, threshold, strict=False, speckle_size=None):
+	mask = arr <= threshold
+	if speckle_size is not None:
+		mask, removed = remove_speckles(mask, speckle_size)
+		h, w = mask.shape
+		report_speckles(*speck_counts(removed, 0, 0, w, h))
+	return mask_to_components(arr, mask, strict=strict)
+
+# Components of pixels at most threshold, with 4-connectivity if strict and 8-connectivity
+# otherwise, in order of first pixel. If speckle size is given, specks up to that size
+# are removed first.
+def iter_components(im, threshold, strict=False, speckle_size=None):
+	return array_to_components(image_to_array(im), threshold, strict=strict, speckle_size=speckle_size)
+
+def find_components(im, threshold, strict=False, speckle_size=None):
+	return list(iter_components(im, threshold, strict=strict, speckle_size=speckle_size))
+
+# Add black pixels outside rectangle connected to component pixels at border of rectangle.
 def expand_component(im, x_min, y_min, w, h, component, threshold):
+	xs, ys = component.pixels()
 	to_visit = []
-	visited = set()
-	for x, y, _ in component:
-		# print(x, y, x_min, y_min)
+	for x, y in zip(xs.tolist(), ys.tolist()):
 		if x == x_min:
 			to_visit.append((x-1,y))
 		if x == x_min + w - 1:
@@ -148,43 +452,105 @@ def expand_component(im, x_min, y_min, w, h, component, threshold):
 			to_visit.append((x,y-1))
 		if y == y_min + h - 1:
 			to_visit.append((x,y+1))
-	for x_diff in range(w):
-		for y_diff in range(h):
-			visited.add((x_min + x_diff, y_min + y_diff))
+	visited = set()
+	added = []
 	neighbours = [(-1,0),(1,0),(0,-1),(0,1)]
 	while len(to_visit) > 0:
 		(x1,y1) = to_visit.pop()
-		if is_black(im, x1, y1, threshold) and (x1,y1) not in visited:
+		inside = x_min <= x1 < x_min + w and y_min <= y1 < y_min + h
+		if not inside and (x1,y1) not in visited and is_black(im, x1, y1, threshold):
 			visited.add((x1,y1))
-			component.append((x1, y1, im.getpixel((x1,y1))))
+			added.append((x1, y1, im.getpixel((x1,y1))))
 			for x_diff, y_diff in neighbours:
 				to_visit.append((x1+x_diff,y1+y_diff))
+	if len(added) == 0:
+		return component
+	return Component.from_pixels(np.concatenate((xs, [x for x, _, _ in added])), \
+		np.concatenate((ys, [y for _, y, _ in added])), \
+		np.concatenate((component.grays, [p for _, _, p in added])))
 
-def visit_white(im, visited, x, y, threshold):
-	w, h = im.size
-	to_visit = [(x,y)]
-	while len(to_visit) > 0:
-		(x1,y1) = to_visit.pop()
-		if is_white(im, x1, y1) and (x1,y1) not in visited:
-			visited.add((x1,y1))
-			for x_diff in [-1,0,1]:
-				for y_diff in [-1,0,1]:
-					if x_diff != 0 or y_diff != 0:
-						to_visit.append((x1+x_diff,y1+y_diff))
-
-def find_component_list(im, visited, x, y, threshold, strict=False):
-	component = find_component(im, visited, x, y, threshold, strict=strict)
-	return [component] if len(component) > 0 else []
+# Components of tile together with rectangle of tile, and numbers of removed pixels and specks.
+# For removing specks, the tile is cropped with a margin, so that specks are only removed
+# if they are isolated also in the page.
+def tile_task(args):
+	tile, box, margin_box, threshold, strict, speckle_size = args
+	arr = image_to_array(tile)
+	mask = arr <= threshold
+	x_min = box[0] - margin_box[0]
+	y_min = box[1] - margin_box[1]
+	x_max = x_min + box[2] - box[0]
+	y_max = y_min + box[3] - box[1]
+	n_pixels = 0
+	n_specks = 0
+	if speckle_size is not None:
+		mask, removed = remove_speckles(mask, speckle_size)
+		n_pixels, n_specks = speck_counts(removed, x_min, y_min, x_max, y_max)
+	components = mask_to_components(arr[y_min:y_max,x_min:x_max], mask[y_min:y_max,x_min:x_max], strict=strict)
+	return box, [c.translate(box[0], box[1]) for c in components], n_pixels, n_specks
 
-def find_components(im, threshold, strict=False):
+# Tiles of the strip of the page starting at x, from top to bottom.
+def tile_tasks(im, x, tile_size, threshold, strict, speckle_size):
 	w, h = im.size
-	visited = set()
-	components = []
-	for x in range(w):
-		for y in range(h):
-			for c in find_component_list(im, visited, x, y, threshold, strict=strict):
-				components.append(c)
-	return components
+	margin = speckle_size + 1 if speckle_size is not None else 0
+	for y in range(0, h, tile_size):
+		box = (x, y, min(x + tile_size, w), min(y + tile_size, h))
+		margin_box = (max(0, box[0] - margin), max(0, box[1] - margin), \
+			min(w, box[2] + margin), min(h, box[3] + margin))
+		yield im.crop(margin_box), box, margin_box, threshold, strict, speckle_size
+
+# Same components as iter_components, but labeling tiles independently, possibly in parallel,
+# so that only one tile needs per-pixel bookkeeping at a time. Tiles are done in vertical strips,
+# from left to right. Components crossing tile borders are joined by union-find on the runs at
+# tile borders. Once a strip is done, only components reaching its right edge are kept for
+# stitching with the next strip; the others are generated as soon as no component still to come
+# can have a smaller first pixel.
+def iter_components_tiled(im, threshold, strict=False, tile_size=TILE_SIZE, workers=None, speckle_size=None):
+	w, _ = im.size
+	executor = ProcessPoolExecutor(max_workers=workers) if workers is not None and workers > 1 else None
+	pending = []
+	finished = []
+	n_pixels = 0
+	n_specks = 0
+	try:
+		for x in range(0, w, tile_size):
+			tasks = tile_tasks(im, x, tile_size, threshold, strict, speckle_size)
+			results = executor.map(tile_task, tasks) if executor is not None else map(tile_task, tasks)
+			components = pending
+			border_runs = []
+			for i, c in enumerate(pending):
+				border = c.x1s == x
+				for y, x0, x1 in zip(c.ys[border].tolist(), c.x0s[border].tolist(), c.x1s[border].tolist()):
+					border_runs.append((y, x0, x1, i))
+			for (x_min, y_min, x_max, y_max), tile_comps, tile_pixels, tile_specks in results:
+				n_pixels += tile_pixels
+				n_specks += tile_specks
+				for c in tile_comps:
+					border = (c.ys == y_min) | (c.ys == y_max-1) | (c.x0s == x_min) | (c.x1s == x_max)
+					for y, x0, x1 in zip(c.ys[border].tolist(), c.x0s[border].tolist(), c.x1s[border].tolist()):
+						border_runs.append((y, x0, x1, len(components)))
+					components.append(c)
+			border_runs.sort()
+			union_find = UnionFind(len(components))
+			if len(border_runs) > 0:
+				ys, x0s, x1s, labels = (np.array(vals) for vals in zip(*border_runs))
+				sources, targets = touching_runs(ys, x0s, x1s, strict)
+				for label, other in set(zip(labels[sources].tolist(), labels[targets].tolist())):
+					union_find.union(label, other)
+			x_next = min(x + tile_size, w)
+			pending = []
+			for group in union_find.groups():
+				c = components[group[0]] if len(group) == 1 else Component.merge([components[i] for i in group])
+				if x_next < w and np.any(c.x1s == x_next):
+					pending.append(c)
+				else:
+					heapq.heappush(finished, (c.first(), c))
+			bound = min([c.first() for c in pending] + [(x_next, 0)])
+			while len(finished) > 0 and finished[0][0] < bound:
+				yield heapq.heappop(finished)[1]
+	finally:
+		if executor is not None:
+			executor.shutdown()
+	report_speckles(n_pixels, n_specks)
 
 def find_outside(im, threshold=BLACK_THRESHOLD):
 	w, h = im.size
@@ -196,3 +562,27 @@ def find_outside(im, threshold=BLACK_THRESHOLD):
 		visit_white(im, visited, 0, y, threshold)
 		visit_white(im, visited, w-1, y, threshold)
 	return make_image(w, h, visited), visited
+
+class UnionFind:
+	def __init__(self, n):
+		self.parents = list(range(n))
+
+	def find(self, i):
+		while self.parents[i] != i:
+			self.parents[i] = self.parents[self.parents[i]]
+			i = self.parents[i]
+		return i
+
+	def union(self, i, j):
+		i = self.find(i)
+		j = self.find(j)
+		if i == j:
+			return False
+		self.parents[max(i, j)] = min(i, j)
+		return True
+
+	def groups(self):
+		groups = defaultdict(list)
+		for i in range(len(self.parents)):
+			groups[self.find(i)].append(i)
+		return list(groups.values())
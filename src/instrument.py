@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import functools
+import resource
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Timing of stages and counters per page, written as one JSON line per page to a report file.
+# Off unless a report file is given, either by enable or by environment variable
+# OCR_REPORT, which is also how worker processes inherit it. When off, stage and count
+# return immediately.
+#
+# Memory tracing (enable_memory, or OCR_MEMORY) adds to the report the resident set size
+# and the peak of memory allocated by Python and NumPy per stage, and the lines of code
+# holding most memory at the highest point seen in the page.
+# A soft limit on the resident set size (OCR_MEMORY_LIMIT, in MB) is checked at the start and
+# end of stages and at counters, and aborts the page with MemoryLimitError.
+
+report_env = 'OCR_REPORT'
+memory_env = 'OCR_MEMORY'
+memory_limit_env = 'OCR_MEMORY_LIMIT'
+
+TOP_ALLOCATORS = 10
+SNAPSHOT_GROWTH = 1.25
+MB = 1024 * 1024
+
+report_file = os.environ.get(report_env)
+trace_memory = os.environ.get(memory_env) is not None
+memory_limit = float(os.environ[memory_limit_env]) if memory_limit_env in os.environ else None
+current = None
+
+class MemoryLimitError(Exception):
+	pass
+
+def enable(filename):
+	global report_file
+	report_file = os.path.abspath(filename)
+	os.environ[report_env] = report_file
+
+def enable_memory(limit=None, trace=True):
+	global trace_memory, memory_limit
+	if trace:
+		trace_memory = True
+		os.environ[memory_env] = '1'
+	if limit is not None:
+		memory_limit = limit
+		os.environ[memory_limit_env] = str(limit)
+
+def is_active():
+	return report_file is not None or trace_memory or memory_limit is not None
+
+# Current resident set size in MB.
+def rss():
+	try:
+		with open('/proc/self/statm', 'r') as handle:
+			return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+	except OSError:
+		return peak_rss()
+
+def peak_rss():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def top_allocators(snapshot):
+	return [{'line': '{}:{}'.format(os.path.basename(stat.traceback[0].filename), stat.traceback[0].lineno), \
+			'mb': round(stat.size / MB, 2), 'blocks': stat.count} \
+		for stat in snapshot.statistics('lineno')[:TOP_ALLOCATORS]]
+
+# Check soft limit, and with memory tracing, keep allocations near highest point of page.
+# Allocations are only taken again if memory grew by some factor, as this is slow.
+def check_memory(stage_name):
+	if current is None:
+		return
+	if trace_memory:
+		traced, _ = tracemalloc.get_traced_memory()
+		current['top_traced'] = max(current['top_traced'], traced)
+		if traced > SNAPSHOT_GROWTH * current['snapshot_traced']:
+			current['snapshot_traced'] = traced
+			current['top_allocators'] = top_allocators(tracemalloc.take_snapshot())
+	if memory_limit is not None:
+		size = rss()
+		if size > memory_limit:
+			raise MemoryLimitError('Page {} uses {:.0f} MB at {}, over limit of {:.0f} MB'.format( \
+				current['page'], size, stage_name, memory_limit))
+
+def new_stage():
+	return {'seconds': 0, 'calls': 0, 'rss_mb': 0, 'peak_traced_mb': 0}
+
+@contextmanager
+def page(name):
+	global current
+	if not is_active():
+		yield
+		return
+	if trace_memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+	current = {'page': name, 'stages': defaultdict(new_stage), 'counters': defaultdict(int), \
+		'peaks': [], 'top_traced': 0, 'snapshot_traced': 0, 'top_allocators': []}
+	start = time.perf_counter()
+	try:
+		check_memory('start of page')
+		yield
+	finally:
+		entry = {'page': name, 'seconds': round(time.perf_counter() - start, 4), \
+			'stages': {stage: stage_entry(val) for stage, val in current['stages'].items()}, \
+			'counters': dict(current['counters'])}
+		if trace_memory:
+			entry['memory'] = {'peak_rss_mb': round(peak_rss(), 1), 'rss_mb': round(rss(), 1), \
+				'top_traced_mb': round(current['top_traced'] / MB, 2), 'top_allocators': current['top_allocators']}
+		current = None
+		if report_file is not None:
+			with open(report_file, 'a') as handle:
+				handle.write(json.dumps(entry) + '\n')
+
+def stage_entry(val):
+	entry = {'seconds': round(val['seconds'], 4), 'calls': val['calls']}
+	if trace_memory:
+		entry['rss_mb'] = round(val['rss_mb'], 1)
+		entry['peak_traced_mb'] = round(val['peak_traced_mb'], 2)
+	return entry
+
+# Time spent in stage is added up over calls within the page. With memory tracing,
+# the peak of allocated memory is taken per stage; peaks of enclosing stages include
+# those of nested stages.
+@contextmanager
+def stage(name):
+	if current is None:
+		yield
+		return
+	check_memory(name)
+	if trace_memory:
+		_, peak = tracemalloc.get_traced_memory()
+		current['peaks'] = [max(p, peak) for p in current['peaks']] + [0]
+		tracemalloc.reset_peak()
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		if current is not None:
+			val = current['stages'][name]
+			val['seconds'] += time.perf_counter() - start
+			val['calls'] += 1
+			if trace_memory:
+				_, peak = tracemalloc.get_traced_memory()
+				peak = max(peak, current['peaks'].pop())
+				current['peaks'] = [max(p, peak) for p in current['peaks']]
+				val['peak_traced_mb'] = max(val['peak_traced_mb'], peak / MB)
+				val['rss_mb'] = max(val['rss_mb'], rss())
+	check_memory(name)
+
+def count(name, n=1):
+	if current is not None:
+		current['counters'][name] += n
+		check_memory(name)
+
+# Decorator timing every call of function as stage.
+def timed(name):
+	def decorate(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if current is None:
+				return function(*args, **kwargs)
+			with stage(name):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorate
@@ -2,18 +2,21 @@ import sys
 import os
 import re
 import shutil
-from PIL import Image
 
 from tables import resources_dir, signlist_dir
 from imageprocessing import make_image
 from segments import Segment, overlap
+import instrument
+import pageio
 
-def preamble(name):
+# Stages by which page was degraded for lack of time are named in meta element.
+def preamble(name, degraded=[]):
 	 return \
 """<html>
 <head>
 <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
 """ + \
+	('<meta name="degraded" content="{}">\n'.format(' '.join(degraded)) if len(degraded) > 0 else '') + \
 	'<title>{}</title>'.format(name) + \
 """
 <link rel="stylesheet" type="text/css" href="transcription.css">
@@ -80,7 +83,8 @@ class Token:
 
 class OcrPage:
 	def __init__(self, filename):
-		self.im = Image.open(filename)
+		self.filename = filename
+		self.im = pageio.open_image(filename)
 		self.w, self.h = self.im.size
 
 	def remove_words(self, x, y, w, h):
@@ -145,6 +149,29 @@ class OcrPage:
 		if change:
 			self.lines = [line for para in self.paras for line in para.lines]
 
+	# Paragraphs with their lines and words as nested lists, for storing in cache.
+	def get_layout(self):
+		return [[para.offset, para.length, para.x, para.y, para.w, para.h, \
+				[[line.offset, line.length, \
+					[[word.content, word.confidence, word.offset, word.length, \
+						word.x, word.y, word.w, word.h, word.style] for word in line.words]] \
+					for line in para.lines]] \
+			for para in self.paras]
+
+	def set_layout(self, layout):
+		self.paras = []
+		for offset, length, x, y, w, h, lines in layout:
+			para = OcrPara(offset, length, x, y, w, h)
+			for line_offset, line_length, words in lines:
+				line = OcrLine(line_offset, line_length)
+				for content, confidence, word_offset, word_length, word_x, word_y, word_w, word_h, style in words:
+					word = OcrWord(content, confidence, word_offset, word_length, word_x, word_y, word_w, word_h)
+					word.style = style
+					line.words.append(word)
+				para.lines.append(line)
+			self.paras.append(para)
+		self.lines = [line for para in self.paras for line in para.lines]
+
 	def is_page_header(self, para):
 		x, y, w, h = self.text_corners
 		return len(para.lines) == 1 and y < para.y + para.h/40 and \
@@ -192,7 +219,7 @@ class OcrPage:
 		rel_name = os.path.join(rel_dir, str(i) + '.png')
 		image_name = os.path.join(target_dir, str(i) + '.png')
 		image_tag = '<img src="{}">\n'.format(rel_name)
-		para_image.save(image_name)
+		pageio.save_image(para_image, image_name)
 		return image_tag + self.para_to_html(para)
 
 	def para_to_html(self, para):
@@ -212,7 +239,8 @@ class OcrPage:
 		para_text = ''.join([str(token) for token in tokens])
 		return '<p>' + para_text + '</p>\n'
 
-	def to_html(self, target_dir, name, cutouts=False):
+	@instrument.timed('to_html')
+	def to_html(self, target_dir, name, cutouts=False, degraded=[]):
 		html_file = os.path.join(target_dir, name + '.html')
 		if cutouts:
 			rel_dir = name + 'cutouts'
@@ -222,11 +250,11 @@ class OcrPage:
 			txts = [self.para_to_image_html(para, rel_dir, cutouts_dir, i) for i, para in enumerate(self.paras)]
 		else:
 			txts = [self.para_to_html(para) for para in self.paras]
+		instrument.count('paragraphs', len(self.paras))
 		content = ''.join(txts)
 		content = content.replace(' .', '.')
-		html = preamble(name) + content + postamble
-		with open(html_file, "w") as handle:
-			handle.write(html)
+		html = preamble(name, degraded) + content + postamble
+		pageio.write_text(html_file, html)
 
 class OcrWord:
 	def __init__(self, content, confidence, offset, length, x, y, w, h):
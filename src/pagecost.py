@@ -0,0 +1,63 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from imageprocessing import BLACK_THRESHOLD, image_to_array, reduce_darkest, iter_components
+from stagecache import StageCache
+
+# Estimated time to process a page, so that a batch can start with the most expensive pages,
+# and workers are not left idle at the end while one of them goes through a long page.
+# The estimate is linear in features that are cheap to compute: size of the file in MB,
+# fraction of dark pixels and thousands of components at reduced resolution, and whether
+# hieroglyphic is still to be found (no .csv file yet). The weights are fitted by least squares
+# to the times of pages done earlier, once there are enough of these; until then default
+# weights are used.
+
+FEATURE_SCALE = 4
+MIN_FIT_PAGES = 10
+MB = 1024 * 1024
+
+feature_names = ['mb', 'ink', 'components', 'detect']
+default_weights = [0.5, 0.5, 5.0, 2.0, 1.0]
+
+# Features that depend on the image only are kept in the stage cache.
+def page_features(imagefile):
+	cache = StageCache(imagefile)
+	features = cache.get('features', cache.image_hash) if cache.image_hash is not None else None
+	if features is None:
+		try:
+			reduced = reduce_darkest(Image.open(imagefile), FEATURE_SCALE)
+		except OSError:
+			return {name: 0 for name in feature_names}
+		n_components = sum(1 for _ in iter_components(reduced, BLACK_THRESHOLD))
+		features = {'mb': round(os.path.getsize(imagefile) / MB, 3), \
+			'ink': round(float((image_to_array(reduced) < BLACK_THRESHOLD).mean()), 4), \
+			'components': n_components / 1000}
+		cache.put('features', cache.image_hash, features)
+	features['detect'] = 0 if os.path.isfile(imagefile + '.csv') else 1
+	return features
+
+def feature_vector(features):
+	return [1] + [features[name] for name in feature_names]
+
+def estimate(features, weights):
+	return max(0, float(np.dot(feature_vector(features), weights)))
+
+# Weights fitted to journal entries of finished pages that were not degraded.
+def fit_weights(entries):
+	entries = [entry for entry in entries if entry.get('status') == 'done' and 'features' in entry \
+		and 'degraded' not in entry]
+	if len(entries) < MIN_FIT_PAGES:
+		return default_weights
+	features = np.array([feature_vector(entry['features']) for entry in entries])
+	seconds = np.array([entry['seconds'] for entry in entries])
+	weights, _, _, _ = np.linalg.lstsq(features, seconds, rcond=None)
+	return [float(weight) for weight in weights]
+
+# Image files with their features and estimated seconds, most expensive first.
+def order_by_cost(imagefiles, weights):
+	with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+		featuress = list(executor.map(page_features, imagefiles))
+	costs = [(imagefile, features, estimate(features, weights)) for imagefile, features in zip(imagefiles, featuress)]
+	return sorted(costs, key=lambda cost: -cost[2])
@@ -0,0 +1,134 @@
+import os
+import json
+import queue
+import threading
+import traceback
+from PIL import Image
+
+# Reading of pages and writing of results away from the thread doing the computation.
+# A PageReader decodes the images and parses the Azure results of the next few pages on a
+# background thread, into a bounded queue, while the current page is processed. The image and
+# results of the current page are then shared by all stages; images are never changed in place.
+# A Writer saves images and HTML on a background thread. Without reader or writer, pages are
+# read and results written directly.
+
+PREFETCH_DEPTH = 2
+WRITE_DEPTH = 64
+
+loaded = {}
+writer = None
+
+def read_page(imagefile):
+	files = {}
+	im = Image.open(imagefile)
+	im.load()
+	files[imagefile] = im
+	json_name = imagefile + '.json'
+	if os.path.exists(json_name):
+		with open(json_name, 'r') as f:
+			files[json_name] = json.load(f)
+	return files
+
+def open_image(filename):
+	if filename in loaded:
+		return loaded[filename]
+	return Image.open(filename)
+
+def read_json(filename):
+	if filename in loaded:
+		return loaded[filename]
+	with open(filename, 'r') as f:
+		return json.load(f)
+
+# Iterates over image files, each having been read while the previous ones were processed.
+# Pages that cannot be read are left to fail when processed.
+class PageReader:
+	def __init__(self, imagefiles, depth=PREFETCH_DEPTH):
+		self.pages = queue.Queue(maxsize=depth)
+		self.thread = threading.Thread(target=self.run, args=(imagefiles,), daemon=True)
+		self.thread.start()
+
+	def run(self, imagefiles):
+		for imagefile in imagefiles:
+			try:
+				files = read_page(imagefile)
+			except Exception:
+				files = {}
+			self.pages.put((imagefile, files))
+		self.pages.put(None)
+
+	def __iter__(self):
+		try:
+			while True:
+				item = self.pages.get()
+				if item is None:
+					return
+				imagefile, files = item
+				loaded.clear()
+				loaded.update(files)
+				yield imagefile
+		finally:
+			loaded.clear()
+
+# Writes in order of submission. Errors are collected until the next call of after_writes.
+class Writer(threading.Thread):
+	def __init__(self, depth=WRITE_DEPTH):
+		threading.Thread.__init__(self, daemon=True)
+		self.tasks = queue.Queue(maxsize=depth)
+		self.errors = []
+
+	def run(self):
+		while True:
+			task = self.tasks.get()
+			if task is None:
+				return
+			function, args = task
+			try:
+				function(*args)
+			except Exception:
+				self.errors.append(traceback.format_exc())
+
+	def submit(self, function, *args):
+		self.tasks.put((function, args))
+
+	def close(self):
+		self.tasks.put(None)
+		self.join()
+
+def start_writer():
+	global writer
+	writer = Writer()
+	writer.start()
+
+def stop_writer():
+	global writer
+	writer.close()
+	writer = None
+
+def write_text_now(filename, text):
+	with open(filename, 'w') as handle:
+		handle.write(text)
+
+def save_image(im, filename):
+	if writer is None:
+		im.save(filename)
+	else:
+		writer.submit(im.save, filename)
+
+def write_text(filename, text):
+	if writer is None:
+		write_text_now(filename, text)
+	else:
+		writer.submit(write_text_now, filename, text)
+
+# Call function with errors of writes submitted before, once these are done.
+def after_writes(function, *args):
+	if writer is None:
+		function([], *args)
+	else:
+		writer.submit(take_errors, function, args)
+
+def take_errors(function, args):
+	errors = writer.errors
+	writer.errors = []
+	function(errors, *args)
@@ -3,24 +3,51 @@ import sys
 import csv
 import os
 import string
+import glob
+import gc
+import json
+import time
+import queue
+import traceback
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor
 
-from findhiero import find_hiero_in_page
-from train import default_letter_model_dir
+
+import findhiero
+from findhiero import find_hiero_in_page, triage_page, write_empty_csv, manual_adjust, retranscribe_degraded, \
+		get_sign_letter_fontinfo, get_sign_fontinfo
+from train import default_letter_model_dir, model_fingerprint
 from azure import AzurePage
-from simpleocr import FontInfo, median_height, do_ocr
+from simpleocr import get_letter_fontinfo, do_ocr
 from ocrresults import prepare_transcription_dir
+from calibration import calibrated_unit_height
+from stagecache import StageCache, inputs_hash
+import instrument
+import profiling
+import budget
+import pageio
+import pagecost
 
 transcription_dir = 'transcriptions'
+journal_name = 'journal.jsonl'
 
-def recognize_hiero(imagefile):
+# With triage, the window for a page where a quick check finds nothing starts without rectangles.
+@instrument.timed('recognize_hiero')
+def recognize_hiero(imagefile, triage=False):
 	csvfile = imagefile + '.csv'
 	if not os.path.isfile(imagefile):
 		print('No such file', imagefile)
 		return False
 	elif not os.path.isfile(csvfile):
-		find_hiero_in_page(imagefile)
+		im = pageio.open_image(imagefile)
+		if not triage or triage_page(imagefile, im):
+			find_hiero_in_page(imagefile)
+		else:
+			print('No hieroglyphic found in', imagefile)
+			manual_adjust(imagefile, im, [])
 		return False
 	else:
+		retranscribe_degraded(imagefile, pageio.open_image(imagefile))
 		return True
 
 def read_csv(imagefile):
@@ -36,29 +63,61 @@ def remove_hiero(page, hiero):
 def add_hiero(page, hiero):
 	page.add_word(hiero['ch'], 'hiero', hiero['x'], hiero['y'], hiero['w'], hiero['h'])
 
-def do_simple_ocr(page):
-	unit_height = median_height(page.im)
-	fontinfo = FontInfo(default_letter_model_dir, unit_height)
-	for line in page.lines:
-		adjust_line(line)
-		for word in line.words:
-			adjust_word(page, word, fontinfo)
+# Unit height, cached under the page and the words used to estimate it.
+def page_unit_height(page, cache):
+	words = [word for line in page.lines for word in line.words if word.style != 'hiero']
+	key = inputs_hash(cache.image_hash, [[word.x, word.y, word.w, word.h] for word in words], page.text_corners)
+	unit_height = cache.get('unitheight', key)
+	if unit_height is None:
+		unit_height = calibrated_unit_height(page.filename, page.im, words=words, corners=page.text_corners)
+		cache.put('unitheight', key, unit_height)
 	return unit_height
 
-def adjust_word(page, word, fontinfo):
-	subimage = page.im.crop((word.x, word.y, word.x+word.w, word.y+word.h))
-	style, content = do_ocr(page, word, fontinfo)
-	if word.style == 'normal' or re.match(r'[0-9][\.\),]?\.?$', word.content):
-		match style:
-			case 'bold':
-				word.style = style
-			case 'smallcaps':
-				if not word.content.lower() in \
-					['on', 'of', 'to', 'two', 'no.', 'nos.', 'gods', 'stool']:
+# OCR of words is cached per page, unit height and letter model. Within that, each word is
+# found by its rectangle, so that after changing the hieroglyphic, other words are not done again.
+@instrument.timed('do_simple_ocr')
+def do_simple_ocr(page, unit_height, cache):
+	fontinfo = get_letter_fontinfo(default_letter_model_dir, unit_height)
+	key = inputs_hash(cache.image_hash, unit_height, model_fingerprint(default_letter_model_dir))
+	results = cache.get('ocr', key) or {}
+	n_results = len(results)
+	with budget.stage('ocr'):
+		for line in page.lines:
+			adjust_line(line)
+			for word in line.words:
+				adjust_word(page, word, fontinfo, results)
+	if len(results) > n_results:
+		cache.put('ocr', key, results)
+
+# None if out of time before word could be recognized.
+def word_ocr(page, word, fontinfo, results):
+	word_key = '{} {} {} {}'.format(word.x, word.y, word.w, word.h)
+	if word_key not in results:
+		if budget.exceeded('ocr'):
+			return None
+		results[word_key] = do_ocr(page, word, fontinfo)
+		instrument.count('words_ocr')
+	else:
+		instrument.count('words_cached')
+	style, content = results[word_key]
+	return style, content
+
+# Without recognition of word, the style and text from Azure are kept.
+def adjust_word(page, word, fontinfo, results):
+	recognized = word_ocr(page, word, fontinfo, results)
+	if recognized is not None:
+		style, content = recognized
+		if word.style == 'normal' or re.match(r'[0-9][\.\),]?\.?$', word.content):
+			match style:
+				case 'bold':
 					word.style = style
-	if word.confidence < 0.8:
-		if not re.match('^[-0-9\\.,;\\(\\)\\[\\]xi]+$', word.content):
-			word.content = content
+				case 'smallcaps':
+					if not word.content.lower() in \
+						['on', 'of', 'to', 'two', 'no.', 'nos.', 'gods', 'stool']:
+						word.style = style
+		if word.confidence < 0.8:
+			if not re.match('^[-0-9\\.,;\\(\\)\\[\\]xi]+$', word.content):
+				word.content = content
 	word.content = re.sub(r'\bIst\b', '1st', word.content)
 	word.content = re.sub(r'([0-9])-([0-9])', r'\1–\2', word.content)
 	word.content = re.sub(r'(\w)Ꜥ', r'\1ꜥ', word.content)
@@ -90,21 +149,239 @@ def adjust_line(line):
 def get_page(imagefile):
 	return AzurePage(imagefile)
 
-def produce_html(imagefile):
-	prepare_transcription_dir(transcription_dir)
-	name, _ = os.path.splitext(os.path.basename(imagefile))
+# Page with hieroglyphic in place of words, if there is a csv file, and its unit height.
+def prepare_page(imagefile, cache):
 	page = get_page(imagefile)
-	hieros = read_csv(imagefile)
+	hieros = read_csv(imagefile) if os.path.isfile(imagefile + '.csv') else []
 	for hiero in hieros:
 		remove_hiero(page, hiero)
 	for hiero in hieros:
 		add_hiero(page, hiero)
 	page.widen_to_lines()
-	unit_height = do_simple_ocr(page)
-	page.merge_paras(1.5 * unit_height)
-	page.to_html(transcription_dir, name, cutouts=True)
+	return page, page_unit_height(page, cache)
+
+@instrument.timed('produce_html')
+def produce_html(imagefile):
+	prepare_transcription_dir(transcription_dir)
+	name, _ = os.path.splitext(os.path.basename(imagefile))
+	cache = StageCache(imagefile)
+	page, unit_height = prepare_page(imagefile, cache)
+	key = inputs_hash(cache.image_hash, cache.json_hash, cache.csv_hash, unit_height, \
+		model_fingerprint(default_letter_model_dir))
+	layout = cache.get('layout', key)
+	if layout is None:
+		do_simple_ocr(page, unit_height, cache)
+		page.merge_paras(1.5 * unit_height)
+		if not budget.is_degraded('ocr'):
+			cache.put('layout', key, page.get_layout())
+	else:
+		page.set_layout(layout)
+	page.to_html(transcription_dir, name, cutouts=True, degraded=budget.degraded)
+
+def html_file(imagefile):
+	name, _ = os.path.splitext(os.path.basename(imagefile))
+	return os.path.join(transcription_dir, name + '.html')
+
+# Whether HTML of page exists and is newer than the image, the OCR results and the hieroglyphic.
+def is_up_to_date(imagefile):
+	htmlfile = html_file(imagefile)
+	if not os.path.isfile(htmlfile) or not os.path.isfile(imagefile + '.csv'):
+		return False
+	inputs = [f for f in [imagefile, imagefile + '.json', imagefile + '.csv'] if os.path.isfile(f)]
+	return os.path.getmtime(htmlfile) > max(os.path.getmtime(f) for f in inputs)
+
+# Image files of directories, of glob patterns, of manifests (text files listing one path
+# or pattern per line), or given directly.
+def batch_image_files(paths):
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			files.extend(sorted(glob.glob(os.path.join(path, '*.png'))))
+		elif glob.has_magic(path):
+			files.extend(sorted(glob.glob(path)))
+		elif path.endswith('.txt'):
+			with open(path, 'r') as handle:
+				lines = [line.strip() for line in handle]
+			files.extend(batch_image_files([line for line in lines if line != '']))
+		else:
+			files.append(path)
+	return files
+
+def journal_file():
+	return os.path.join(transcription_dir, journal_name)
+
+# Each line of journal is a JSON object with page and status, and possibly seconds, error,
+# stages by which page was degraded, and features and estimated seconds used for scheduling.
+# A single short line is appended at a time, so that workers can write to it concurrently.
+def write_journal(entry):
+	with open(journal_file(), 'a') as handle:
+		handle.write(json.dumps(entry) + '\n')
+		handle.flush()
+		os.fsync(handle.fileno())
+
+def read_journal_entries():
+	entries = []
+	if os.path.exists(journal_file()):
+		with open(journal_file(), 'r') as handle:
+			for line in handle:
+				try:
+					entries.append(json.loads(line))
+				except json.JSONDecodeError:
+					continue
+	return entries
+
+# Last status of each page in journal.
+# Pages done with degraded results have status degraded.
+def read_journal():
+	return {entry['page']: 'degraded' if 'degraded' in entry else entry['status'] for entry in read_journal_entries()}
+
+# Pages that need processing. Pages that were started but not finished, that failed,
+# or whose results were degraded, are done again, even if their output seems up to date.
+def pending_pages(imagefiles):
+	statuses = read_journal()
+	return [f for f in imagefiles if statuses.get(os.path.abspath(f)) in ['started', 'failed', 'degraded'] or \
+		not is_up_to_date(f)]
+
+# Load models once per worker process.
+def warm_models():
+	findhiero.parallel_transcription = False
+	get_sign_letter_fontinfo()
+	get_sign_fontinfo()
+	get_letter_fontinfo()
+
+# Hieroglyphic is found without opening a window if there is no csv file yet.
+# With triage, a page where a quick check finds nothing gets an empty csv file instead.
+# Pages without Azure results fail, rather than ending the worker.
+def process_page(imagefile, triage=False):
+	page = os.path.abspath(imagefile)
+	write_journal({'page': page, 'status': 'started'})
+	start = time.time()
+	if not os.path.isfile(imagefile + '.json'):
+		return {'page': page, 'status': 'failed', 'seconds': 0, 'error': 'Need JSON in {}.json'.format(imagefile)}
+	try:
+		with instrument.page(page), profiling.profile(page), budget.page() as degraded:
+			if not os.path.isfile(imagefile + '.csv'):
+				with instrument.stage('recognize_hiero'):
+					if not triage or triage_page(imagefile, pageio.open_image(imagefile)):
+						find_hiero_in_page(imagefile, interactive=False)
+					else:
+						write_empty_csv(imagefile)
+			else:
+				retranscribe_degraded(imagefile, pageio.open_image(imagefile))
+			produce_html(imagefile)
+		entry = {'page': page, 'status': 'done', 'seconds': round(time.time() - start, 3)}
+		if len(degraded) > 0:
+			entry['degraded'] = degraded
+		return entry
+	except instrument.MemoryLimitError as e:
+		gc.collect()
+		return {'page': page, 'status': 'failed', 'seconds': round(time.time() - start, 3), 'error': str(e)}
+	except (Exception, SystemExit):
+		return {'page': page, 'status': 'failed', 'seconds': round(time.time() - start, 3), \
+			'error': traceback.format_exc()}
+
+# Journal entry of page is passed on once its HTML and cutouts have been written.
+def report_page(errors, entry, results):
+	if len(errors) > 0 and entry['status'] == 'done':
+		entry['status'] = 'failed'
+		entry['error'] = ''.join(errors)
+	results.put(entry)
+
+# Each worker takes pages from the shared queue until it finds None, reading a few pages
+# ahead of the one being processed.
+def process_pages(tasks, results, triage=False):
+	pageio.start_writer()
+	try:
+		for imagefile in pageio.PageReader(iter(tasks.get, None)):
+			entry = process_page(imagefile, triage)
+			pageio.after_writes(report_page, entry, results)
+	finally:
+		pageio.stop_writer()
+
+# Entries of pages, as these come in. If a worker died, its error is raised.
+def collect_results(results, futures, n):
+	while n > 0:
+		try:
+			entry = results.get(timeout=1)
+		except queue.Empty:
+			for future in futures:
+				if future.done():
+					future.result()
+			continue
+		n -= 1
+		yield entry
+
+# Pages are done longest first, by estimated time.
+def process_batch(paths, workers=None, triage=False):
+	prepare_transcription_dir(transcription_dir)
+	imagefiles = batch_image_files(paths)
+	pending = pending_pages(imagefiles)
+	print('Processing', len(pending), 'of', len(imagefiles), 'pages')
+	weights = pagecost.fit_weights(read_journal_entries())
+	costs = pagecost.order_by_cost(pending, weights)
+	page_costs = {os.path.abspath(imagefile): (features, round(seconds, 3)) for imagefile, features, seconds in costs}
+	worked = 0
+	n_workers = max(1, min(workers or os.cpu_count(), len(pending)))
+	start = time.time()
+	with Manager() as manager, ProcessPoolExecutor(max_workers=n_workers, initializer=warm_models) as executor:
+		tasks = manager.Queue()
+		results = manager.Queue()
+		for imagefile in [imagefile for imagefile, _, _ in costs] + [None] * n_workers:
+			tasks.put(imagefile)
+		futures = [executor.submit(process_pages, tasks, results, triage) for _ in range(n_workers)]
+		for entry in collect_results(results, futures, len(pending)):
+			entry['features'], entry['estimate'] = page_costs[entry['page']]
+			worked += entry['seconds']
+			write_journal(entry)
+			print(entry['status'].capitalize(), entry['page'], entry['seconds'], 'estimated', entry['estimate'])
+			if 'degraded' in entry:
+				print('Degraded by', ', '.join(entry['degraded']))
+			if entry['status'] == 'failed':
+				print(entry['error'])
+	if len(pending) > 0:
+		print('Finished in {:.1f} seconds, with {:.1f} seconds of work, estimated {:.1f}'.format( \
+			time.time() - start, worked, sum(seconds for _, _, seconds in costs)))
+	profiling.merge()
 
 if __name__ == '__main__':
-	if len(sys.argv) >= 2:
-		imagefile = sys.argv[1]
-		recognize_hiero(imagefile) and produce_html(imagefile)
+	args = sys.argv[1:]
+	workers = None
+	triage = False
+	if '--workers' in args:
+		i = args.index('--workers')
+		workers = int(args[i+1])
+		args = args[:i] + args[i+2:]
+	if '--report' in args:
+		i = args.index('--report')
+		instrument.enable(args[i+1])
+		args = args[:i] + args[i+2:]
+	if '--memory' in args:
+		instrument.enable_memory()
+		args.remove('--memory')
+	if '--memory-limit' in args:
+		i = args.index('--memory-limit')
+		instrument.enable_memory(limit=float(args[i+1]), trace=False)
+		args = args[:i] + args[i+2:]
+	if '--profile' in args:
+		i = args.index('--profile')
+		profiling.enable(args[i+1])
+		args = args[:i] + args[i+2:]
+	if '--budget' in args:
+		i = args.index('--budget')
+		budget.enable(page_seconds=float(args[i+1]))
+		args = args[:i] + args[i+2:]
+	if '--stage-budgets' in args:
+		i = args.index('--stage-budgets')
+		budget.enable(stage_seconds=budget.parse_stage_budgets(args[i+1]))
+		args = args[:i] + args[i+2:]
+	if '--triage' in args:
+		triage = True
+		args.remove('--triage')
+	if len(args) >= 2 and args[0] == '--batch':
+		process_batch(args[1:], workers=workers, triage=triage)
+	elif len(args) >= 1:
+		imagefile = args[0]
+		with instrument.page(os.path.abspath(imagefile)), profiling.profile(os.path.abspath(imagefile)), \
+				budget.page():
+			recognize_hiero(imagefile, triage=triage) and produce_html(imagefile)
+		profiling.merge()
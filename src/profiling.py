@@ -0,0 +1,157 @@
+import os
+import sys
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Sampling profiler, off unless a directory for the profiles is given, either by enable or by
+# environment variable OCR_PROFILE, which is also how worker processes inherit it.
+# While a profile runs, a thread records the stack of the profiled thread at regular intervals.
+# Each profile is written as collapsed stacks, one line per stack with frames separated by
+# semicolons followed by the number of samples, which flame graph tools take as input.
+# Frames are tagged with their subsystem, which is the module for modules of this directory,
+# as in 'imageprocessing:squared_dist' or 'segments:Segment.merge', and otherwise 'lib' followed
+# by the installed package if any, as in 'lib.PIL:Image.resize'. Frames of instrument are left out.
+# Once all profiles of a run are done, merge gives the sum of all profiles in the directory,
+# and samples are summed per subsystem and per function.
+
+profile_env = 'OCR_PROFILE'
+profile_ext = '.collapsed'
+merged_name = 'merged'
+summary_name = 'subsystems.txt'
+
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 10
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+profile_dir = os.environ.get(profile_env)
+
+def enable(directory):
+	global profile_dir
+	profile_dir = os.path.abspath(directory)
+	os.environ[profile_env] = profile_dir
+
+def code_subsystem(filename):
+	if filename.startswith('<'):
+		return 'lib'
+	filename = os.path.abspath(filename)
+	if os.path.dirname(filename) == src_dir:
+		return os.path.splitext(os.path.basename(filename))[0]
+	parts = filename.split(os.sep)
+	if 'site-packages' in parts and parts.index('site-packages') + 1 < len(parts):
+		package = parts[parts.index('site-packages') + 1]
+		return 'lib.' + os.path.splitext(package)[0]
+	return 'lib'
+
+def frame_label(frame):
+	code = frame.f_code
+	return code_subsystem(code.co_filename) + ':' + getattr(code, 'co_qualname', code.co_name)
+
+def label_subsystem(label):
+	return label.split(':')[0]
+
+def is_lib(subsystem):
+	return subsystem == 'lib' or subsystem.startswith('lib.')
+
+class Sampler(threading.Thread):
+	def __init__(self, thread_id):
+		threading.Thread.__init__(self, daemon=True)
+		self.thread_id = thread_id
+		self.stacks = defaultdict(int)
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(SAMPLE_INTERVAL):
+			frame = sys._current_frames().get(self.thread_id)
+			labels = []
+			while frame is not None:
+				label = frame_label(frame)
+				if label_subsystem(label) != 'instrument':
+					labels.append(label)
+				frame = frame.f_back
+			if len(labels) > 0:
+				self.stacks[';'.join(reversed(labels))] += 1
+
+def profile_file(name):
+	safe_name = name.strip(os.sep).replace(os.sep, '_').replace(' ', '_')
+	return os.path.join(profile_dir, safe_name + profile_ext)
+
+def write_stacks(filename, stacks):
+	tmp_name = '{}.{}.tmp'.format(filename, os.getpid())
+	with open(tmp_name, 'w') as handle:
+		for stack, n in sorted(stacks.items()):
+			handle.write('{} {}\n'.format(stack, n))
+	os.replace(tmp_name, filename)
+
+def read_stacks(filename):
+	stacks = defaultdict(int)
+	with open(filename, 'r') as handle:
+		for line in handle:
+			stack, n = line.rstrip('\n').rsplit(' ', 1)
+			stacks[stack] += int(n)
+	return stacks
+
+# Samples per subsystem in own time (innermost frame), in own time including libraries called
+# (innermost frame not in a library) and in total time (anywhere on stack), and functions
+# with most samples in own time.
+def summarize(stacks):
+	own = defaultdict(int)
+	attributed = defaultdict(int)
+	total = defaultdict(int)
+	functions = defaultdict(int)
+	for stack, n in stacks.items():
+		labels = stack.split(';')
+		own[label_subsystem(labels[-1])] += n
+		subsystems = [label_subsystem(label) for label in labels]
+		callers = [subsystem for subsystem in subsystems if not is_lib(subsystem)]
+		attributed[callers[-1] if len(callers) > 0 else subsystems[-1]] += n
+		functions[labels[-1]] += n
+		for subsystem in set(subsystems):
+			total[subsystem] += n
+	n_samples = sum(stacks.values())
+	lines = ['{} samples of {} ms'.format(n_samples, round(1000 * SAMPLE_INTERVAL)), '', \
+		'subsystem\town\twith libraries\ttotal']
+	for subsystem in sorted(total, key=lambda s: (-attributed[s], -own[s])):
+		lines.append('{}\t{:.1%}\t{:.1%}\t{:.1%}'.format(subsystem, own[subsystem] / n_samples, \
+			attributed[subsystem] / n_samples, total[subsystem] / n_samples))
+	lines += ['', 'function\town']
+	for label in sorted(functions, key=lambda l: -functions[l])[:TOP_FUNCTIONS]:
+		lines.append('{}\t{:.1%}'.format(label, functions[label] / n_samples))
+	return '\n'.join(lines) + '\n'
+
+def merge_profiles(directory):
+	if not os.path.isdir(directory):
+		return
+	stacks = defaultdict(int)
+	for f in sorted(os.listdir(directory)):
+		if f.endswith(profile_ext) and f != merged_name + profile_ext:
+			for stack, n in read_stacks(os.path.join(directory, f)).items():
+				stacks[stack] += n
+	if len(stacks) == 0:
+		return
+	write_stacks(os.path.join(directory, merged_name + profile_ext), stacks)
+	tmp_name = '{}.{}.tmp'.format(os.path.join(directory, summary_name), os.getpid())
+	with open(tmp_name, 'w') as handle:
+		handle.write(summarize(stacks))
+	os.replace(tmp_name, os.path.join(directory, summary_name))
+
+def merge():
+	if profile_dir is not None:
+		merge_profiles(profile_dir)
+
+# Profile of calling thread while in context, stored under name, e.g. of page.
+@contextmanager
+def profile(name):
+	if profile_dir is None:
+		yield
+		return
+	os.makedirs(profile_dir, exist_ok=True)
+	sampler = Sampler(threading.get_ident())
+	sampler.start()
+	try:
+		yield
+	finally:
+		sampler.stopped.set()
+		sampler.join()
+		write_stacks(profile_file(name), sampler.stacks)
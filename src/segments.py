@@ -1,7 +1,11 @@
+import math
+import numpy as np
 from PIL import Image, ImageChops
+from collections import defaultdict
 
 from imageprocessing import normalize_image, white_image, make_image, area, \
-		is_black, n_black, find_components, expand_component
+		image_to_array, Component, iter_components, iter_components_tiled, \
+		expand_component, TILE_SIZE, MAX_UNTILED_AREA
 
 MIN_SEGMENT_AREA = 6
 MIN_BLACK_AREA = 0.01
@@ -28,33 +32,22 @@ class Segment:
 		return Segment(self.im, self.x + x, self.y + y)
 
 	def component(self, threshold):
-		comp = []
-		for x in range(self.w):
-			for y in range(self.h):
-				if is_black(self.im, x, y, threshold):
-					comp.append((self.x + x, self.y + y, self.im.getpixel((x,y))))
-		return comp
+		arr = image_to_array(self.im)
+		ys, xs = np.nonzero(arr <= threshold)
+		return Component.from_pixels(xs + self.x, ys + self.y, arr[ys, xs])
 
 	def cut_from_page(self, page):
 		return page.crop((self.x, self.y, self.x+self.w, self.y+self.h))
 
 	def recreate_from_page(self, page, threshold):
 		component = self.component(threshold)
-		expand_component(page, self.x, self.y, self.w, self.h, component, threshold)
+		component = expand_component(page, self.x, self.y, self.w, self.h, component, threshold)
 		return Segment.from_component(component)
 
 	@staticmethod
 	def from_component(component):
-		x_offset = min([x for x,_,_ in component])
-		x_max = max([x for x,_,_ in component])
-		y_offset = min([y for _,y,_ in component])
-		y_max = max([y for _,y,_ in component])
-		w = x_max - x_offset + 1
-		h = y_max - y_offset + 1
-		im = white_image(w,h)
-		for x, y, p in component:
-			im.putpixel((x-x_offset,y-y_offset), p)
-		return Segment(im, x_offset, y_offset)
+		x, y, _, _ = component.bbox()
+		return Segment(component.to_image(), x, y)
 
 	@staticmethod
 	def from_rectangle(x, y, w, h):
@@ -83,6 +76,16 @@ class Segment:
 			merged = Segment.merge(merged, segment)
 		return merged
 
+	# Merge any number of segments with one paste per segment.
+	@staticmethod
+	def merge_many(segments):
+		x_min, y_min, w, h = segments_to_rect(segments)
+		im = white_image(w,h)
+		for segment in segments:
+			box = (segment.x-x_min, segment.y-y_min, segment.x-x_min+segment.w, segment.y-y_min+segment.h)
+			im.paste(ImageChops.darker(im.crop(box), segment.im), box)
+		return Segment(im, x_min, y_min)
+
 	@staticmethod
 	def merge_big(segments, size=MIN_SEGMENT_AREA):
 		merged = None
@@ -154,19 +157,41 @@ class ClassifiedSegment(Segment):
 		merged = Segment.merge_all(segments)
 		return ClassifiedSegment(merged.im, merged.x, merged.y, None)
 
-def image_to_segments(im, threshold, strict=False, min_area=None, min_black_area=None):
-	components = find_components(im, threshold, strict=strict)
-	segments = [Segment.from_component(c) for c in components]
-	if min_area is not None:
-		segments = [segment for segment in segments if min_area <= area(segment.im)]
-	if min_black_area is not None:
-		x = len(segments)
-		segments = [segment for segment in segments \
-			if n_black(segment.im, threshold) >= min_black_area * area(segment.im)]
-		y = len(segments)
-		if y < x:
-			print('from', x, 'to', y)
-	return segments
+def keep_component(component, min_area=None, min_black_area=None):
+	if min_area is not None and component.area() < min_area:
+		return False
+	if min_black_area is not None and component.n_black() < min_black_area * component.area():
+		return False
+	return True
+
+# Components passing filters on area and proportion of black pixels, generated in order
+# of first pixel. Very large images are labeled in tiles, unless tile size is given explicitly.
+# If speckle size is given, isolated specks up to that size are removed before labeling.
+def image_to_components(im, threshold, strict=False, min_area=None, min_black_area=None, \
+		tile_size=None, workers=None, speckle_size=None):
+	if tile_size is None and area(im) > MAX_UNTILED_AREA:
+		tile_size = TILE_SIZE
+	if tile_size is not None:
+		components = iter_components_tiled(im, threshold, strict=strict, tile_size=tile_size, \
+			workers=workers, speckle_size=speckle_size)
+	else:
+		components = iter_components(im, threshold, strict=strict, speckle_size=speckle_size)
+	for component in components:
+		if keep_component(component, min_area=min_area, min_black_area=min_black_area):
+			yield component
+
+# Segments generated lazily, so that images are only made for components passing the filters,
+# and consumers may stop early.
+def iter_segments(im, threshold, strict=False, min_area=None, min_black_area=None, \
+		tile_size=None, workers=None, speckle_size=None):
+	for component in image_to_components(im, threshold, strict=strict, min_area=min_area, \
+			min_black_area=min_black_area, tile_size=tile_size, workers=workers, speckle_size=speckle_size):
+		yield Segment.from_component(component)
+
+def image_to_segments(im, threshold, strict=False, min_area=None, min_black_area=None, \
+		tile_size=None, workers=None, speckle_size=None):
+	return list(iter_segments(im, threshold, strict=strict, min_area=min_area, \
+		min_black_area=min_black_area, tile_size=tile_size, workers=workers, speckle_size=speckle_size))
 
 def segments_to_rect(segments):
 	if len(segments) == 0:
@@ -184,6 +209,37 @@ def segments_to_rect(segments):
 		y_max = max(y_max, segment_i.y + segment_i.h)
 	return x_min, y_min, x_max-x_min, y_max-y_min
 
+def rects_to_rect(rects):
+	x_min = min(x for x, _, _, _ in rects)
+	y_min = min(y for _, y, _, _ in rects)
+	x_max = max(x+w for x, _, w, _ in rects)
+	y_max = max(y+h for _, y, _, h in rects)
+	return x_min, y_min, x_max-x_min, y_max-y_min
+
+# Uniform grid of cells, each holding indices of rectangles intersecting it.
+class SpatialGrid:
+	def __init__(self, rects, cell_size):
+		self.cell_size = max(1, cell_size)
+		self.cells = defaultdict(list)
+		for i, (x, y, w, h) in enumerate(rects):
+			for cell in self.covered_cells(x, y, w, h, 0):
+				self.cells[cell].append(i)
+
+	def covered_cells(self, x, y, w, h, margin):
+		x_min = math.floor((x - margin) / self.cell_size)
+		x_max = math.floor((x + w + margin) / self.cell_size)
+		y_min = math.floor((y - margin) / self.cell_size)
+		y_max = math.floor((y + h + margin) / self.cell_size)
+		return [(i, j) for i in range(x_min, x_max+1) for j in range(y_min, y_max+1)]
+
+	# Indices of rectangles possibly within margin of given rectangle.
+	def near(self, x, y, w, h, margin):
+		indices = set()
+		for cell in self.covered_cells(x, y, w, h, margin):
+			if cell in self.cells:
+				indices.update(self.cells[cell])
+		return sorted(indices)
+
 # testing
 if __name__ == '__main__':
 	im = normalize_image(Image.open('tests/test14.png'))
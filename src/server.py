@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+import findhiero
+import simpleocr
+from findhiero import find_hiero_rects, store_rectangles, transcribe_subimage
+from segments import Segment
+from stagecache import StageCache
+from pipeline import warm_models, prepare_page, do_simple_ocr
+
+# Recognition kept running with models loaded, for tools that would otherwise start a process
+# per page or per rectangle. Requests are JSON objects posted over HTTP on localhost, each
+# handled on its own thread. Detection and OCR keep state of the page in globals of their
+# modules (calibration, page read ahead, budgets, instrumentation), so these requests are
+# handled one at a time. Transcription and status only read the loaded models, and are
+# handled concurrently with all others:
+#	/detect {"image": path, "layout": bool, "scale": n, "speckle": n, "store": bool}
+#		rectangles of hieroglyphic in page, with "store" also written to csv file as by findhiero.py
+#	/transcribe {"image": path, "rects": [[x, y, w, h], ...]}
+#		encodings of hieroglyphic in rectangles of page
+#	/ocr {"image": path}
+#		words of page after OCR, with hieroglyphic from csv file if any
+# GET /status gives fingerprints of the models in memory. Models are loaded again when
+# retrained, at the first request after that. The last few page images are kept decoded.
+# Transcription does not start a pool of processes, which would be forked from a process
+# with several threads.
+
+default_port = 8700
+MAX_IMAGES = 4
+
+page_lock = threading.Lock()
+image_lock = threading.Lock()
+images = OrderedDict()
+
+class RequestError(Exception):
+	pass
+
+def field(request, name):
+	if name not in request:
+		raise RequestError('Missing {}'.format(name))
+	return request[name]
+
+# Decoded image of page, shared between requests; images are never changed in place.
+def open_image(imagefile):
+	if not os.path.isfile(imagefile):
+		raise RequestError('No such file {}'.format(imagefile))
+	key = (os.path.abspath(imagefile), os.path.getmtime(imagefile))
+	with image_lock:
+		if key in images:
+			images.move_to_end(key)
+			return images[key]
+	im = Image.open(imagefile)
+	im.load()
+	with image_lock:
+		images[key] = im
+		while len(images) > MAX_IMAGES:
+			images.popitem(last=False)
+	return im
+
+def detect(request):
+	imagefile = field(request, 'image')
+	im = open_image(imagefile)
+	rects = find_hiero_rects(imagefile, im, layout=request.get('layout', False), \
+		scale=request.get('scale', 1), speckle_size=request.get('speckle'))
+	if request.get('store', False):
+		store_rectangles(imagefile, im, [Segment.from_rectangle(x, y, w, h) for x, y, w, h in rects])
+	return {'rects': [list(rect) for rect in rects]}
+
+def transcribe(request):
+	im = open_image(field(request, 'image'))
+	segments = [Segment.from_rectangle(x, y, w, h) for x, y, w, h in field(request, 'rects')]
+	return {'hieros': [transcribe_subimage(segment.cut_from_page(im)) for segment in segments]}
+
+def ocr(request):
+	imagefile = field(request, 'image')
+	if not os.path.isfile(imagefile + '.json'):
+		raise RequestError('Need JSON in {}'.format(imagefile + '.json'))
+	cache = StageCache(imagefile)
+	page, unit_height = prepare_page(imagefile, cache)
+	do_simple_ocr(page, unit_height, cache)
+	words = [{'content': word.content, 'style': word.style, 'x': word.x, 'y': word.y, 'w': word.w, 'h': word.h} \
+		for line in page.lines for word in line.words]
+	return {'unit_height': unit_height, 'words': words}
+
+def status():
+	models = {}
+	for fontinfos in [findhiero.sign_fontinfos, findhiero.sign_letter_fontinfos, simpleocr.letter_fontinfos]:
+		models.update({model_dir: fingerprint for model_dir, (fingerprint, _) in list(fontinfos.items())})
+	return {'models': models}
+
+handlers = {'/detect': detect, '/transcribe': transcribe, '/ocr': ocr}
+page_handlers = ['/detect', '/ocr']
+
+class RequestHandler(BaseHTTPRequestHandler):
+	def reply(self, code, value):
+		body = json.dumps(value).encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		if self.path == '/status':
+			self.reply(200, status())
+		else:
+			self.reply(404, {'error': 'Unknown path {}'.format(self.path)})
+
+	def do_POST(self):
+		if self.path not in handlers:
+			self.reply(404, {'error': 'Unknown path {}'.format(self.path)})
+			return
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+			request = json.loads(self.rfile.read(length))
+		except ValueError as e:
+			self.reply(400, {'error': str(e)})
+			return
+		try:
+			if self.path in page_handlers:
+				with page_lock:
+					value = handlers[self.path](request)
+			else:
+				value = handlers[self.path](request)
+		except RequestError as e:
+			self.reply(400, {'error': str(e)})
+			return
+		except Exception:
+			self.reply(500, {'error': traceback.format_exc()})
+			return
+		self.reply(200, value)
+
+def serve(port=default_port):
+	warm_models()
+	findhiero.parallel_transcription = False
+	server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+	print('Serving on port', port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	port = default_port
+	if '--port' in args:
+		i = args.index('--port')
+		port = int(args[i+1])
+		args = args[:i] + args[i+2:]
+	serve(port)
@@ -3,20 +3,31 @@ import os
 import sys
 import heapq
 import json
+import math
+import copy
 from PIL import Image
 from collections import defaultdict
 from statistics import median
 
-from imageprocessing import area, image_to_vec, squared_dist_with_aspect_height
-from segments import Segment, image_to_segments, MIN_SEGMENT_AREA
-from train import default_letter_model_dir
+from imageprocessing import Projection, area, image_to_vec, squared_dist_with_aspect_height
+from segments import Segment, image_to_segments, image_to_components, MIN_SEGMENT_AREA
+from train import default_letter_model_dir, model_fingerprint
 from azure import AzurePage
+import instrument
 
 style_list = ['normal', 'italic', 'bold', 'smallcaps']
 
 BEAM_WIDTH = 10
 BLACK_THRESHOLD = 110
 
+SAMPLE_BANDS = 10
+BAND_FRACTION = 0.03
+MIN_BAND_HEIGHT = 48
+SAMPLE_WORDS = 40
+MIN_SAMPLE_SIZE = 30
+
+letter_fontinfos = {}
+
 class FontInfo:
 	def __init__(self, model_dir, unit_height=None):
 		with open(os.path.join(model_dir, 'chars.pickle'), 'rb') as handle:
@@ -29,17 +40,21 @@ class FontInfo:
 			self.aspects = pickle.load(handle)
 		with open(os.path.join(model_dir, 'heights.pickle'), 'rb') as handle:
 			self.heights = pickle.load(handle)
-		with open(os.path.join(model_dir, 'scaler.pickle'), 'rb') as handle:
-			self.scaler = pickle.load(handle)
-		with open(os.path.join(model_dir, 'pca.pickle'), 'rb') as handle:
-			self.pca = pickle.load(handle)
+		self.projection = Projection(model_dir)
 		self.unit_height = unit_height
 
 	def image_to_embedding(self, im):
 		vec = image_to_vec(im)
-		scaled = self.scaler.transform([vec])[0]
-		embedding = self.pca.transform([scaled])[0]
-		return embedding
+		return self.projection.transform([vec])[0]
+
+# Letter model with given unit height. The model is kept in memory, and loaded again only if retrained.
+def get_letter_fontinfo(model_dir=default_letter_model_dir, unit_height=None):
+	fingerprint = model_fingerprint(model_dir)
+	if model_dir not in letter_fontinfos or letter_fontinfos[model_dir][0] != fingerprint:
+		letter_fontinfos[model_dir] = (fingerprint, FontInfo(model_dir))
+	fontinfo = copy.copy(letter_fontinfos[model_dir][1])
+	fontinfo.unit_height = unit_height
+	return fontinfo
 
 def find_closest_letter(embedding, aspect, height, k, fontinfo):
 	dists = [squared_dist_with_aspect_height(embedding, aspect, height, e, a, h) for (e, a, h) \
@@ -49,6 +64,7 @@ def find_closest_letter(embedding, aspect, height, k, fontinfo):
 
 def classify_image_letter(im, k, fontinfo):
 	embedding = fontinfo.image_to_embedding(im)
+	instrument.count('prototypes_scanned', len(fontinfo.embeddings))
 	w, h = im.size
 	aspect = w / h
 	rel_height = h / fontinfo.unit_height
@@ -100,10 +116,56 @@ def do_ocr(page, word, fontinfo):
 				style = 'normal'
 	return style, ch
 
+def segment_heights(im, threshold=BLACK_THRESHOLD):
+	components = image_to_components(im, threshold, strict=True, min_area=MIN_SEGMENT_AREA)
+	return [component.bbox()[3] for component in components]
+
 def median_height(im, threshold=BLACK_THRESHOLD):
-	segments = image_to_segments(im, BLACK_THRESHOLD, strict=True, min_area=MIN_SEGMENT_AREA)
-	heights = [segment.im.size[1] for segment in segments]
-	return median(heights)
+	return median(segment_heights(im, threshold=threshold))
+
+# Median with approximate 95% confidence interval, from order statistics.
+def median_interval(heights, z=1.96):
+	heights = sorted(heights)
+	n = len(heights)
+	half = z * math.sqrt(n) / 2
+	low = heights[max(0, math.floor(n / 2 - half))]
+	high = heights[min(n - 1, math.ceil(n / 2 + half))]
+	return median(heights), low, high
+
+# Heights of components in horizontal bands, leaving out those cut off by the band edges.
+def band_heights(im, n_bands, threshold):
+	w, h = im.size
+	band_h = min(h, max(MIN_BAND_HEIGHT, round(BAND_FRACTION * h)))
+	heights = []
+	for i in range(n_bands):
+		y = round((i + 0.5) * h / n_bands - band_h / 2)
+		y = min(max(0, y), h - band_h)
+		band = im.crop((0, y, w, y + band_h))
+		for component in image_to_components(band, threshold, strict=True, min_area=MIN_SEGMENT_AREA):
+			_, c_y, _, c_h = component.bbox()
+			if c_y > 0 and c_y + c_h < band_h:
+				heights.append(c_h)
+	return heights
+
+def word_heights(im, words, n_words, threshold):
+	step = max(1, len(words) // n_words)
+	heights = []
+	for word in words[::step]:
+		sub = im.crop((word.x, word.y, word.x+word.w, word.y+word.h))
+		heights.extend(segment_heights(sub, threshold=threshold))
+	return heights
+
+# Estimate median component height from a sample of the Azure words if given, otherwise
+# from a sample of horizontal bands. Falls back to the full page if the sample is too small.
+# Returns median and lower and upper bounds of confidence interval.
+def estimate_median_height(im, words=None, threshold=BLACK_THRESHOLD):
+	if words is not None and len(words) > 0:
+		heights = word_heights(im, words, SAMPLE_WORDS, threshold)
+	else:
+		heights = band_heights(im, SAMPLE_BANDS, threshold)
+	if len(heights) < MIN_SAMPLE_SIZE:
+		heights = segment_heights(im, threshold=threshold)
+	return median_interval(heights)
 	
 if __name__ == '__main__':
 	imagefile = '/home/mn31/work/topbib/topbib/ocr/vol1/1.png'
@@ -0,0 +1,49 @@
+import os
+import json
+import hashlib
+import threading
+
+# Outputs of stages of the pipeline, stored under a hash of their inputs, in a subdirectory
+# of the directory of the pages. Entries for inputs that changed are simply no longer found.
+# Remove the subdirectory to clear the cache.
+
+cache_dir_name = 'stagecache'
+
+def file_hash(filename):
+	if not os.path.isfile(filename):
+		return None
+	digest = hashlib.sha1()
+	with open(filename, 'rb') as handle:
+		for chunk in iter(lambda: handle.read(1 << 20), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def inputs_hash(*inputs):
+	return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+class StageCache:
+	def __init__(self, imagefile):
+		self.directory = os.path.join(os.path.dirname(os.path.abspath(imagefile)), cache_dir_name)
+		self.image_hash = file_hash(imagefile)
+		self.json_hash = file_hash(imagefile + '.json')
+		self.csv_hash = file_hash(imagefile + '.csv')
+
+	def filename(self, stage, key):
+		return os.path.join(self.directory, stage, key + '.json')
+
+	def get(self, stage, key):
+		filename = self.filename(stage, key)
+		if os.path.exists(filename):
+			with open(filename, 'r') as handle:
+				return json.load(handle)
+		return None
+
+	# Written to temporary file first, so that concurrent workers and threads never see
+	# partial entries.
+	def put(self, stage, key, value):
+		filename = self.filename(stage, key)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		tmp_name = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+		with open(tmp_name, 'w') as handle:
+			json.dump(value, handle)
+		os.replace(tmp_name, filename)
@@ -8,8 +8,8 @@ from tables import get_name_to_unicode, get_unicode_to_name
 from transcribe import FontInfo as FontInfoSigns, classify_image_full
 from simpleocr import FontInfo as FontInfoLetters, classify_image_letter, style_list
 
-name_to_unicode = get_name_to_unicode()
-unicode_to_name = get_unicode_to_name()
+name_to_unicode = None
+unicode_to_name = None
 
 exemplar_sign_dir = 'newgardiner'
 target_sign_dir = 'topbibhiero'
@@ -17,6 +17,19 @@ target_letter_dir = 'letters'
 
 CANVAS_SIZE = 200
 
+# Tables are loaded on first use.
+def lookup_name_to_unicode():
+	global name_to_unicode
+	if name_to_unicode is None:
+		name_to_unicode = get_name_to_unicode()
+	return name_to_unicode
+
+def lookup_unicode_to_name():
+	global unicode_to_name
+	if unicode_to_name is None:
+		unicode_to_name = get_unicode_to_name()
+	return unicode_to_name
+
 def classify_sign(im, fontinfo):
 	indexes = classify_image_full(im, 1, fontinfo)
 	return ord(fontinfo.chars[indexes[0]])
@@ -103,8 +116,8 @@ class SignStorer(Storer):
 
 	def update_from_name(self):
 		name = self.name.get()
-		if name in name_to_unicode:
-			self.code = name_to_unicode[name]
+		if name in lookup_name_to_unicode():
+			self.code = lookup_name_to_unicode()[name]
 			self.update_from_code()
 		elif name == 'shade':
 			self.code = 0x13443
@@ -127,8 +140,8 @@ class SignStorer(Storer):
 			x_offset, y_offset, rescaled = white_image()
 		self.im_code = ImageTk.PhotoImage(rescaled)
 		self.exemplar.create_image(x_offset, y_offset, anchor=tk.NW, image=self.im_code)
-		if chr(self.code) in unicode_to_name:
-			return unicode_to_name[chr(self.code)]
+		if chr(self.code) in lookup_unicode_to_name():
+			return lookup_unicode_to_name()[chr(self.code)]
 		elif self.code == 0x13443:
 			return 'shade'
 		else:
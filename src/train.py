@@ -3,13 +3,13 @@ import sys
 from PIL import Image
 import pickle
 import re
-
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
+import hashlib
+import numpy as np
 
 from tables import get_unicode_to_name, numerals, composite, repeated_single
-from imageprocessing import BLACK_THRESHOLD, normalize_image, area, image_to_vec
+from imageprocessing import BLACK_THRESHOLD, Projection, normalize_image, area, image_to_vec, closest_with_aspect
 from segments import image_to_segments
+import profiling
 
 default_sign_font_dirs = ['gardiner', 'newgardiner', 'topbibhiero']
 default_letter_font_dirs = ['letters']
@@ -18,6 +18,17 @@ default_letter_model_dir = 'lettermodel'
 default_sign_letter_model_dir = 'signlettermodel'
 default_pca_dim = 30
 
+# Fraction of disagreements with nearest neighbour that fall within margin of discriminator.
+DISCRIMINATOR_COVERAGE = 0.99
+
+# Changes whenever a file in the model directory is rewritten.
+def model_fingerprint(model_dir):
+	digest = hashlib.sha1()
+	for filename in sorted(os.listdir(model_dir)):
+		stat = os.stat(os.path.join(model_dir, filename))
+		digest.update('{} {} {}\n'.format(filename, stat.st_size, stat.st_mtime_ns).encode())
+	return digest.hexdigest()
+
 def ascender(ch):
 	return ch in ['b', 'd', 'f', 'fi', 'h', 'i', 'k', 'l', 'th', '6', '8', ]
 
@@ -289,7 +300,10 @@ def get_prototypes_signs_letters(sign_dirs, letter_dirs):
 	aspects = sign_aspects + letter_aspects
 	return issign, vecs, aspects
 
+# scikit-learn is only imported for training; recognition applies the exported projection.
 def train_signs(prototype_dirs, model_dir, pca_dim):
+	from sklearn.preprocessing import StandardScaler
+	from sklearn.decomposition import PCA
 	chars, partss, vecs_core, vecs_full, aspects_core, aspects_full, dimensions = \
 			get_prototypes_signs(prototype_dirs)
 	scaler = StandardScaler()
@@ -320,12 +334,11 @@ def train_signs(prototype_dirs, model_dir, pca_dim):
 		pickle.dump(aspects_full, handle)
 	with open(os.path.join(model_dir, 'dimensions.pickle'), 'wb') as handle:
 		pickle.dump(dimensions, handle)
-	with open(os.path.join(model_dir, 'scaler.pickle'), 'wb') as handle:
-		pickle.dump(scaler, handle)
-	with open(os.path.join(model_dir, 'pca.pickle'), 'wb') as handle:
-		pickle.dump(pca, handle)
+	Projection.save(model_dir, scaler.mean_, scaler.scale_, pca.mean_, pca.components_)
 
 def train_letters(prototype_dirs, model_dir, pca_dim):
+	from sklearn.preprocessing import StandardScaler
+	from sklearn.decomposition import PCA
 	chars, styles, vecs, aspects, heights = get_prototypes_letters(prototype_dirs)
 	scaler = StandardScaler()
 	scaled = scaler.fit_transform(vecs)
@@ -343,29 +356,55 @@ def train_letters(prototype_dirs, model_dir, pca_dim):
 		pickle.dump(aspects, handle)
 	with open(os.path.join(model_dir, 'heights.pickle'), 'wb') as handle:
 		pickle.dump(heights, handle)
-	with open(os.path.join(model_dir, 'scaler.pickle'), 'wb') as handle:
-		pickle.dump(scaler, handle)
-	with open(os.path.join(model_dir, 'pca.pickle'), 'wb') as handle:
-		pickle.dump(pca, handle)
+	Projection.save(model_dir, scaler.mean_, scaler.scale_, pca.mean_, pca.components_)
+
+def discriminator_features(embeddings, aspects):
+	return np.column_stack([embeddings, np.log(aspects)])
+
+def discriminator_scores(embeddings, aspects, discriminator):
+	features = discriminator_features(embeddings, aspects)
+	return features @ discriminator['weights'] + discriminator['bias']
+
+# Linear approximation of whether nearest prototype (other than itself) is a sign.
+# Near the decision boundary, within margin, the nearest neighbour is to be used instead.
+def train_discriminator(issign, embeddings, aspects):
+	from sklearn.linear_model import LogisticRegression
+	aspects = np.asarray(aspects)
+	nearest = closest_with_aspect(embeddings, aspects, embeddings, aspects, exclude_self=True)
+	knn_issign = np.array([issign[i] for i in nearest])
+	regression = LogisticRegression(max_iter=1000)
+	regression.fit(discriminator_features(embeddings, aspects), knn_issign)
+	discriminator = {'weights': regression.coef_[0], 'bias': regression.intercept_[0], 'margin': 0}
+	scores = discriminator_scores(embeddings, aspects, discriminator)
+	agree = (scores > 0) == knn_issign
+	if not agree.all():
+		discriminator['margin'] = np.quantile(np.abs(scores[~agree]), DISCRIMINATOR_COVERAGE)
+	fast = np.abs(scores) >= discriminator['margin']
+	print('Discriminator agrees with nearest neighbour: {:3.4f}'.format(agree.mean()))
+	print('Decided by discriminator: {:3.4f}, of which agree: {:3.4f}'.format(fast.mean(), \
+		agree[fast].mean() if fast.any() else 1))
+	return discriminator
 
 def train_signs_letters(sign_dirs, letter_dirs, model_dir, pca_dim):
+	from sklearn.preprocessing import StandardScaler
+	from sklearn.decomposition import PCA
 	issign, vecs, aspects = get_prototypes_signs_letters(sign_dirs, letter_dirs)
 	scaler = StandardScaler()
 	scaled = scaler.fit_transform(vecs)
 	pca = PCA(n_components=pca_dim)
 	embeddings = pca.fit_transform(scaled)
+	discriminator = train_discriminator(issign, embeddings, aspects)
 	if not os.path.exists(model_dir):
 		os.mkdir(model_dir)
 	with open(os.path.join(model_dir, 'issign.pickle'), 'wb') as handle:
 		pickle.dump(issign, handle)
+	with open(os.path.join(model_dir, 'discriminator.pickle'), 'wb') as handle:
+		pickle.dump(discriminator, handle)
 	with open(os.path.join(model_dir, 'embeddings.pickle'), 'wb') as handle:
 		pickle.dump(embeddings, handle)
 	with open(os.path.join(model_dir, 'aspects.pickle'), 'wb') as handle:
 		pickle.dump(aspects, handle)
-	with open(os.path.join(model_dir, 'scaler.pickle'), 'wb') as handle:
-		pickle.dump(scaler, handle)
-	with open(os.path.join(model_dir, 'pca.pickle'), 'wb') as handle:
-		pickle.dump(pca, handle)
+	Projection.save(model_dir, scaler.mean_, scaler.scale_, pca.mean_, pca.components_)
 
 def train_signs_default():
 	font_dirs = default_sign_font_dirs
@@ -386,7 +425,20 @@ def train_sign_recognition_default():
 	pca_dim = default_pca_dim
 	train_signs_letters(sign_dirs, letter_dirs, model_dir, pca_dim)
 
+# Export projection of model trained with earlier version, which pickled scaler and PCA.
+def export_projection(model_dir):
+	projection = Projection(model_dir)
+	Projection.save(model_dir, projection.scale_mean, projection.scale, projection.pca_mean, \
+		projection.components)
+
 if __name__ == '__main__':
-	train_signs_default()
-	train_letters_default()
-	train_sign_recognition_default()
+	if len(sys.argv) > 1 and sys.argv[1] == '--export':
+		for model_dir in [default_sign_model_dir, default_letter_model_dir, default_sign_letter_model_dir]:
+			if os.path.isdir(model_dir):
+				export_projection(model_dir)
+		sys.exit(0)
+	with profiling.profile('train'):
+		train_signs_default()
+		train_letters_default()
+		train_sign_recognition_default()
+	profiling.merge()
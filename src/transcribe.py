@@ -5,21 +5,30 @@ import os
 import sys
 import heapq
 
-from imageprocessing import BLACK_THRESHOLD, area, image_to_vec, normalize_image, \
+from imageprocessing import BLACK_THRESHOLD, Projection, area, image_to_vec, normalize_image, \
 		aspects_similar, squared_dist, squared_dist_with_aspect
 from segments import MIN_SEGMENT_AREA, Segment, ClassifiedSegment, image_to_segments, segments_to_rect
 from tables import get_insertions, signlist_dir, get_unicode_to_name
 from controls import Horizontal, Vertical, Basic, FULL_LOST, TALL_LOST, WIDE_LOST, \
 		D12, N5, Z1, Z4, Z5, Z5a, Z13, Z14
 from train import default_sign_model_dir
+import instrument
+import budget
 
-name_to_insertions = get_insertions()
+# Loaded on first use, so that importing has no cost.
+name_to_insertions = None
 diagonals = [Z4, Z5, Z5a, Z14, FULL_LOST]
 circles = [D12, Z13]
 
 BEAM_WIDTH = 10
 OVERLAP_RATIO = 6
 
+def get_name_to_insertions():
+	global name_to_insertions
+	if name_to_insertions is None:
+		name_to_insertions = get_insertions()
+	return name_to_insertions
+
 class FontInfo:
 	def __init__(self, model_dir):
 		with open(os.path.join(model_dir, 'chars.pickle'), 'rb') as handle:
@@ -36,16 +45,11 @@ class FontInfo:
 			self.aspects_full = pickle.load(handle)
 		with open(os.path.join(model_dir, 'dimensions.pickle'), 'rb') as handle:
 			self.dimensions = pickle.load(handle)
-		with open(os.path.join(model_dir, 'scaler.pickle'), 'rb') as handle:
-			self.scaler = pickle.load(handle)
-		with open(os.path.join(model_dir, 'pca.pickle'), 'rb') as handle:
-			self.pca = pickle.load(handle)
+		self.projection = Projection(model_dir)
 
 	def image_to_embedding(self, im):
 		vec = image_to_vec(im)
-		scaled = self.scaler.transform([vec])[0]
-		embedding = self.pca.transform([scaled])[0]
-		return embedding
+		return self.projection.transform([vec])[0]
 
 def squared_dist_with_aspect_all(vals1, aspect1, vals_core, vals_full, aspect2, unit):
 	if aspects_similar(aspect1, aspect2):
@@ -137,6 +141,10 @@ def find_best_chars(classifieds_list, fontinfo):
 		best_indices = []
 		segment = classifieds_list[i]
 		candidates = segment.ch
+		if budget.exceeded('parts'):
+			classifieds.append(ClassifiedSegment(segment.im, segment.x, segment.y, fontinfo.chars[candidates[0]]))
+			i = i+1
+			continue
 		for candidate in candidates:
 			dist, merged, indices = \
 					find_best_with_parts(classifieds_list, i, segment, candidate, fontinfo)
@@ -165,7 +173,10 @@ def image_to_signs(im, fontinfo, unit):
 	tallest = max([segment.h for segment in segments])
 	segments = sorted(segments, key=lambda s: -s.area())
 	classifieds_list = classify_segments_core(segments, fontinfo, unit)
-	classifieds = find_best_chars(classifieds_list, fontinfo)
+	instrument.count('segments_classified', len(segments))
+	instrument.count('prototypes_scanned', len(segments) * len(fontinfo.embeddings_core))
+	with budget.stage('parts'):
+		classifieds = find_best_chars(classifieds_list, fontinfo)
 	for sign in classifieds:
 		correct_Z1(sign, widest, tallest)
 	return classifieds
@@ -269,7 +280,7 @@ def distance_loc(loc1, loc2):
 	return (loc1[0] - loc2[0]) * (loc1[0] - loc2[0]) + (loc1[1] - loc2[1]) * (loc1[1] - loc2[1])
 
 def corner_control(core, sign):
-	insertions = name_to_insertions[core.ch]
+	insertions = get_name_to_insertions()[core.ch]
 	loc = relative_corner_location(core, sign)
 	best_corner = max(insertions.keys(), key=lambda c: -distance_loc(insertions[c], loc))
 	return best_corner
@@ -295,7 +306,7 @@ def basic_to_structure(group):
 	corners = defaultdict(list)
 	for sign in group[1:]:
 		if sign.area() >= core.area() / 100 and \
-				core.ch in name_to_insertions:
+				core.ch in get_name_to_insertions():
 			corner = corner_control(core, sign)
 			corners[corner].append(sign)
 	for corner in corners:
@@ -329,6 +340,7 @@ def horsubgroup_to_structure(group):
 	else:
 		return basic_to_structure(group)
 
+@instrument.timed('image_to_encoding')
 def image_to_encoding(im, fontinfo, dir=None):
 	w, h = im.size
 	if dir is None: